@@ -0,0 +1,387 @@
+# Description: Offline benchmark of ems_screenshot.py against local stand-in pages of the DWD, UWZ and metmaps sites
+__version__ = "1.0.0"
+__author__  = "Juri Hubrig"
+
+
+# import necessary modules
+import os
+import sys
+import json
+import base64
+import logging
+import argparse
+import threading
+import subprocess
+import tempfile
+import configparser
+from pathlib import Path
+from io import BytesIO
+from time import sleep, perf_counter
+from datetime import datetime as dt, timedelta as td, timezone as tz
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from argparse import Namespace
+from PIL import Image
+
+import ems_screenshot as ems
+
+
+# credentials of the stand-in metmaps page
+username, password = "bench", "bench"
+
+# the DWD stand-in: the map is drawn into #svgBox after render_ms, below the #headerBox of the #appBox
+dwd_page = """<!DOCTYPE html>
+<html><head><title>DWD stand-in</title>{assets}</head>
+<body style="margin:0">
+<div id="appBox" style="width:900px">
+   <div id="headerBox" style="height:60px;background:#004b87;color:#fff">Warnungen Landkreise</div>
+   <div id="svgBox" style="height:760px;background:#eef"></div>
+</div>
+<script>
+setTimeout(() => document.getElementById("svgBox").innerHTML = '<svg width="900" height="760">{shapes}</svg>', {render_ms});
+</script>
+</body></html>
+"""
+
+# the UWZ stand-in: a Leaflet-like map, the warning overlay (svg > g) is added after render_ms
+uwz_page = """<!DOCTYPE html>
+<html><head><title>UWZ stand-in</title>{assets}</head>
+<body style="margin:0">
+<div id="mapContainer" style="width:556px;height:600px;background:#dde">
+   <div class="leaflet-map-pane"><div class="leaflet-overlay-pane"></div></div>
+</div>
+<script>
+setTimeout(() => document.querySelector(".leaflet-overlay-pane").innerHTML = '<svg class="leaflet-zoom-animated" width="556" height="600"><g>{shapes}</g></svg>', {render_ms});
+</script>
+</body></html>
+"""
+
+# the metmaps stand-in (behind basic auth): the map image is an image input inside a form
+metmaps_page = """<!DOCTYPE html>
+<html><head><title>metmaps stand-in</title>{assets}</head>
+<body style="margin:0">
+<form class="mf"><span id="container"><div id="imgdiv"><span id="outline">
+   <input type="image" id="inputimage" src="/asset/map.png" width="800" height="600">
+</span></div></span></form>
+</body></html>
+"""
+
+
+def stand_in_shapes(n=40):
+   """
+   Returns n colored SVG polygons, standing in for the warning areas.
+   """
+   colors = ("#ff0", "#f90", "#f00", "#909")
+   return "".join(
+      f'<polygon points="{20 * i % 800},{35 * i % 700} {20 * i % 800 + 60},{35 * i % 700 + 10} {20 * i % 800 + 30},{35 * i % 700 + 70}" fill="{colors[i % 4]}"/>'
+      for i in range(n)
+   )
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+   """
+   Serves the stand-in pages and their assets, each response delayed by the configured latency.
+   """
+   def do_GET(self):
+      # simulate the latency of the network and the server
+      sleep(self.server.latency / 1000)
+
+      path = self.path.split("?")[0]
+      match path:
+         case "/dwd" | "/uwz":
+            template = dwd_page if path == "/dwd" else uwz_page
+            self.reply(template.format(assets=self.server.assets, shapes=self.server.shapes, render_ms=self.server.render_ms).encode(), "text/html")
+         case "/metmaps":
+            # the metmaps page needs basic auth
+            if self.headers.get("Authorization") != "Basic " + base64.b64encode(f"{username}:{password}".encode()).decode():
+               self.send_response(401)
+               self.send_header("WWW-Authenticate", 'Basic realm="metmaps"')
+               self.send_header("Content-Length", "0")
+               self.end_headers()
+               return
+            self.reply(metmaps_page.format(assets=self.server.assets).encode(), "text/html")
+         case "/asset/map.png":
+            self.reply(self.server.map_png, "image/png")
+         case _ if path.startswith("/asset/") and path.endswith(".js"):
+            self.reply(self.server.script, "application/javascript")
+         case _:
+            self.send_error(404)
+
+   def reply(self, body, content_type):
+      """
+      Sends the body with status 200.
+      """
+      self.send_response(200)
+      self.send_header("Content-Type", content_type)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def log_message(self, format, *args):
+      # don't print every request
+      pass
+
+
+def start_server(options):
+   """
+   Starts the local HTTP server with the stand-in pages in a background thread and returns it.
+   """
+   server               = ThreadingHTTPServer(("127.0.0.1", options.port), StandInHandler)
+   server.daemon_threads = True
+   server.latency       = options.latency
+   server.render_ms     = options.render_ms
+   server.shapes        = stand_in_shapes()
+   # every page loads the same number of scripts with the configured payload size
+   server.assets        = "".join(f'<script src="/asset/{i}.js"></script>' for i in range(options.assets))
+   server.script        = b"/*" + b"x" * max(0, options.payload * 1024 - 4) + b"*/"
+   # the metmaps map is a noise image, so it is about as hard to compress as a real map
+   buffer               = BytesIO()
+   Image.effect_noise((800, 600), 64).convert("RGB").save(buffer, "PNG")
+   server.map_png       = buffer.getvalue()
+   threading.Thread(target=server.serve_forever, daemon=True).start()
+   return server
+
+
+def bench_args(options, engine, browser, output_dir):
+   """
+   Returns the settings of ems_screenshot.py for a benchmark run, independent of the config.ini
+   except for the site registry, whose URLs are replaced by the stand-in pages.
+   """
+   base     = f"http://127.0.0.1:{options.port}"
+   config   = configparser.ConfigParser(interpolation=None)
+   config.read(Path(ems.__file__).with_name("config.ini"))
+   registry = ems.load_sites(config, { "u": f"{base}/uwz", "d": f"{base}/dwd", "m": f"{base}/metmaps" })
+   return Namespace(
+      browser           = browser,
+      engine            = engine,
+      pool_size         = options.pool_size,
+      timeout           = options.timeout * 1000,
+      user_agent        = None,
+      username          = username,
+      password          = password,
+      site_registry     = registry,
+      network_idle      = False,
+      max_uses          = 0,
+      site_concurrency  = 1,
+      max_inflight      = 0,
+      overlap           = "queue",
+      capture_deadline  = options.timeout * 2,
+      interval          = 1,
+      retries           = 0,
+      backoff           = 2,
+      backoff_max       = 20,
+      breaker_threshold = 0,
+      probe_timeout     = 10,
+      change_driven     = 0,
+      heartbeat         = 0,
+      output_dir        = output_dir,
+      watermark         = 1,
+      format            = options.format,
+      compress_level    = 6,
+      lossless          = 1,
+      quality           = 80,
+      encode_workers    = 2,
+      storage           = "files",
+      retention         = "",
+      dedup             = "off",
+      dedup_tolerance   = 0,
+      animation         = 0,
+      vector            = 0,
+      pyramid           = "",
+      pyramid_workers   = 0,
+      serve             = 0,
+      cache             = 0,
+      request_filters   = { site: ems.RequestFilter() for site in registry },
+      readiness         = {
+         site: { "strategy": options.readiness, "selector": selector, "quiet_ms": 200, "max_wait": 10 }
+         for site, selector in (("u", "#mapContainer .leaflet-overlay-pane"), ("d", "#svgBox"), ("m", "#inputimage"))
+      },
+      metrics           = 1,
+      metrics_file      = os.path.join(output_dir, "metrics.jsonl"),
+      prometheus_file   = "",
+      verbose           = False,
+      log               = False
+   )
+
+
+def run_engine(options):
+   """
+   Runs the rounds of one engine and browser (in a child process of the benchmark) and prints the wall time as JSON.
+   All sites are captured once per round, the warm-up rounds are not measured.
+   """
+   args        = bench_args(options, options.engine, options.browser, options.output_dir)
+   logger      = logging.getLogger("ems_benchmark")
+   sites       = [ site for site in args.site_registry if site in options.sites ]
+
+   # the default targets of the sites and the same capture processes as ems_screenshot.py uses for the engine
+   args.targets   = { site: ems.site_target(site, args) for site in sites }
+   dispatcher     = ems.CaptureDispatcher(ems.create_workers(args, logger), args, logger)
+
+   # every round gets its own tick, starting at a fixed datetime
+   dt_start    = dt(2025, 1, 1, tzinfo=tz.utc)
+   started     = None
+   for i in range(options.warmup + options.rounds):
+      if i == options.warmup: started = perf_counter()
+      for site in sites:
+         dispatcher.submit(site, dt_start + td(minutes=i))
+      dispatcher.wait()
+   wall = perf_counter() - started
+   dispatcher.stop()
+
+   print(json.dumps({ "wall": wall, "measured_from": (dt_start + td(minutes=options.warmup)).strftime("%Y-%m-%dT%H:%M:%SZ") }))
+
+
+def tree_rss(pid):
+   """
+   Returns the summed resident set size in bytes of the process and all its descendants (Linux only, else None).
+   """
+   if not os.path.isdir("/proc"): return None
+   parents = {}
+   for entry in os.listdir("/proc"):
+      if not entry.isdigit(): continue
+      try:
+         with open(f"/proc/{entry}/stat") as f:
+            # the parent pid is the second field after the command name (which may contain spaces)
+            parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+      except (OSError, IndexError, ValueError): continue
+
+   tree, added = {pid}, True
+   while added:
+      children = { p for p, parent in parents.items() if parent in tree } - tree
+      tree    |= children
+      added    = bool(children)
+
+   rss = 0
+   for p in tree:
+      try:
+         with open(f"/proc/{p}/statm") as f:
+            rss += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+      except (OSError, IndexError, ValueError): continue
+   return rss
+
+
+def measure(options, engine, browser):
+   """
+   Runs one engine and browser in a child process and returns its throughput, latency percentiles,
+   peak RSS (of the whole process tree incl. the browsers) and CPU time.
+   """
+   with tempfile.TemporaryDirectory(prefix="ems_benchmark_") as output_dir:
+      command = [
+         sys.executable, os.path.abspath(__file__), "--run",
+         "-e", engine, "-b", browser, "-s", options.sites, "-r", str(options.rounds), "-w", str(options.warmup),
+         "-t", str(options.timeout), "--pool_size", str(options.pool_size), "-f", options.format, "--readiness", options.readiness,
+         "--port", str(options.port), "--output_dir", output_dir
+      ]
+      child = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+
+      # sample the memory of the process tree while the child runs
+      peak_rss = 0
+      def sample():
+         nonlocal peak_rss
+         while child.poll() is None:
+            peak_rss = max(peak_rss, tree_rss(child.pid) or 0)
+            sleep(0.2)
+      sampler = threading.Thread(target=sample, daemon=True)
+      sampler.start()
+
+      output = child.stdout.read()
+      # the resource usage of the child includes all of its (waited for) descendants, i.e. the browsers
+      if hasattr(os, "wait4"):
+         _, status, usage  = os.wait4(child.pid, 0)
+         child.returncode  = os.waitstatus_to_exitcode(status)
+         cpu               = usage.ru_utime + usage.ru_stime
+         # ru_maxrss is in KB on Linux and in bytes on macOS
+         peak_rss          = max(peak_rss, usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024))
+      else:
+         child.wait()
+         cpu               = None
+      sampler.join()
+
+      if child.returncode != 0 or not output.strip():
+         return { "engine": engine, "browser": browser, "error": f"exit code {child.returncode}" }
+      run = json.loads(output.strip().splitlines()[-1])
+
+      # the latencies of the measured captures from the metrics file of the run
+      records = []
+      metrics_file = os.path.join(output_dir, "metrics.jsonl")
+      if os.path.exists(metrics_file):
+         with open(metrics_file) as f:
+            records = [ r for r in map(json.loads, f) if r["time"] >= run["measured_from"] ]
+
+   latencies = sorted(r["total"] for r in records if r["outcome"] == "ok")
+   return {
+      "engine":      engine,
+      "browser":     browser,
+      "captures":    len(latencies),
+      "failed":      len(records) - len(latencies),
+      "per_minute":  round(len(latencies) / run["wall"] * 60, 2),
+      "p50":         ems.percentile(latencies, 50) if latencies else None,
+      "p95":         ems.percentile(latencies, 95) if latencies else None,
+      "p99":         ems.percentile(latencies, 99) if latencies else None,
+      "peak_rss_mb": round(peak_rss / 2**20, 1),
+      "cpu_s":       round(cpu, 2) if cpu is not None else None
+   }
+
+
+def print_report(results):
+   """
+   Prints the results as a table.
+   """
+   print(f"{'engine':<9}{'browser':<10}{'ok':>6}{'failed':>8}{'per min':>9}{'p50':>8}{'p95':>8}{'p99':>8}{'RSS MB':>9}{'CPU s':>8}")
+   for r in results:
+      if "error" in r:
+         print(f"{r['engine']:<9}{r['browser']:<10} {r['error']}")
+         continue
+      cells = [ f"{r[k]:>8.2f}" if r[k] is not None else f"{'-':>8}" for k in ("p50", "p95", "p99") ]
+      cpu   = f"{r['cpu_s']:>8.2f}" if r["cpu_s"] is not None else f"{'-':>8}"
+      print(f"{r['engine']:<9}{r['browser']:<10}{r['captures']:>6}{r['failed']:>8}{r['per_minute']:>9.2f}" + "".join(cells) + f"{r['peak_rss_mb']:>9.1f}{cpu}")
+
+
+if __name__ == '__main__':
+
+   # parse command line arguments
+   parser = argparse.ArgumentParser(
+      prog        = "EMS Screenshot Benchmark",
+      description = "Benchmarks the capture engines and browsers of ems_screenshot.py against local stand-in pages (no network access needed)",
+      epilog      = f"© 2025 {__author__}, Version {__version__}"
+   )
+   parser.add_argument('-e', '--engine', default="process,async", help="Comma-separated capture engines to benchmark (process, async, pool)")
+   parser.add_argument('--pool_size', default=0, type=int, help="Number of capture processes of the pool engine (0 = number of CPU cores)")
+   parser.add_argument('-b', '--browser', default="chromium", help="Comma-separated browsers to benchmark (must be installed by playwright)")
+   parser.add_argument('-s', '--sites', default="udm", help="Stand-in sites to capture ([u]wz, [d]wd, [m]etmaps)")
+   parser.add_argument('-r', '--rounds', default=10, type=int, help="Number of measured rounds, each round captures every site once")
+   parser.add_argument('-w', '--warmup', default=1, type=int, help="Number of unmeasured rounds before (e.g. to launch the browsers)")
+   parser.add_argument('-t', '--timeout', default=30, type=int, help="Timeout for the browser in seconds")
+   parser.add_argument('-f', '--format', default="png", choices=set(ems.extensions), help="Output format of the screenshots")
+   parser.add_argument('--readiness', default="load", choices={"load", "quiet"}, help="Readiness strategy of all sites")
+   parser.add_argument('--latency', default=50, type=int, help="Delay of every response of the stand-in server in milliseconds")
+   parser.add_argument('--payload', default=100, type=int, help="Size of every script loaded by the stand-in pages in KB")
+   parser.add_argument('--assets', default=5, type=int, help="Number of scripts loaded by every stand-in page")
+   parser.add_argument('--render_ms', default=200, type=int, help="Milliseconds until the stand-in maps are drawn")
+   parser.add_argument('--port', default=0, type=int, help="Port of the stand-in server (0 = any free port)")
+   parser.add_argument('-o', '--output', help="Also write the results to this JSON file (e.g. to compare builds)")
+   # internal options of the child process which runs one engine and browser
+   parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+   parser.add_argument('--output_dir', help=argparse.SUPPRESS)
+   options = parser.parse_args()
+
+   # in the child process: run the rounds against the server of the parent
+   if options.run:
+      run_engine(options)
+      sys.exit()
+
+   # start the stand-in server and remember its port for the child processes
+   server         = start_server(options)
+   options.port   = server.server_address[1]
+   print(f"Stand-in server on http://127.0.0.1:{options.port} (latency {options.latency} ms, {options.assets} x {options.payload} KB scripts)")
+
+   results = [
+      measure(options, engine, browser)
+      for engine in options.engine.split(",")
+      for browser in options.browser.split(",")
+   ]
+   server.shutdown()
+
+   print_report(results)
+   if options.output:
+      with open(options.output, "w") as f:
+         json.dump({ "version": ems.__version__, "options": vars(options), "results": results }, f, indent=3)
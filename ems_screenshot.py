@@ -4,350 +4,2790 @@ __author__  = "Juri Hubrig"
 
 
 # import necessary modules
+import os
 import sys
+import signal
+import asyncio
+import platform
+import threading
+import subprocess
+import json
+import copy
+import atexit
 import logging
+import contextvars
+import struct
+import re
+import ast
+import hashlib
+import gzip
+import sqlite3
 import argparse
 import traceback
 import configparser
 from pathlib import Path, PurePath
-from multiprocessing import Process
-from time import sleep
+from itertools import count
+from multiprocessing import Process, Queue
+from logging.handlers import QueueHandler, RotatingFileHandler, TimedRotatingFileHandler
+from queue import Empty
+from io import BytesIO
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from xml.sax.saxutils import escape
+from time import sleep, monotonic, time, perf_counter
+from math import ceil, inf
+from random import uniform
 from datetime import datetime as dt, timedelta as td, timezone as tz
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import lru_cache
+from bisect import bisect_left, bisect_right
+from fnmatch import fnmatchcase
+from playwright.async_api import async_playwright
 
 
 # define the available browsers
 browsers_available = {"chromium", "chrome", "firefox", "edge", "webkit"}
 
 
-def u(args, dt_utc, logger):
+async def launch_browser(playwright, browser_name):
    """
-   Takes a screenshot of the UWZ weather warning map for Germany.
+   Launches the chosen browser with the given playwright instance.
    """
-   # set the URL and image path
-   URL         = 'https://www.weatherpro.com/de/germany/berlin/berlin/iframe?mapregion=deutschland'
-   image_path  = Path(f"{args.output_dir}/uwz_{dt_minutes_file(dt_utc)}.png")
+   match browser_name:
+      case "chromium":
+         return await playwright.chromium.launch()
+      case "chrome":
+         return await playwright.chromium.launch(channel="chrome")
+      case "firefox":
+         return await playwright.firefox.launch()
+      case "edge":
+         return await playwright.chromium.launch(channel="msedge")
+      case "webkit":
+         return await playwright.webkit.launch()
+      case _:
+         raise ValueError(f"Browser {browser_name} not supported. Please choose from {browsers_available}.")
 
-   # use playwright to take a screenshot of the UWZ weather warning map
-   with sync_playwright() as p:
+
+# URL parameters of the metmaps map time and their datetime formats
+metmaps_time_params = { "tim": "%Y%m%d%H%M", "dd": "%d", "mm": "%m", "yy": "%Y", "hh": "%H", "ii": "%M" }
+
+
+def metmaps_url(url, dt_utc):
+   """
+   Fills the datetime into the metmaps URL template: tim=YYYYmmddHHMM and the dd, mm, yy, hh and ii parameters (if present).
+   """
+   for param, fmt in metmaps_time_params.items():
+      url = re.sub(rf"([?&]{param}=)[^&]*", lambda match: match.group(1) + dt_utc.strftime(fmt), url)
+   return url
+
+
+# names of the bounding box values of an element in the clip rules of the sites
+box_fields  = ("x", "y", "width", "height")
+# an element in a clip rule: {selector} or {selector}.x, .y, .width or .height
+clip_terms  = re.compile(r"\{([^{}]+)\}(?:\.(x|y|width|height))?")
+# the syntax nodes allowed in the expressions of a clip rule (arithmetic of numbers and bounding box values)
+clip_nodes  = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Name, ast.Load, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.USub, ast.UAdd)
+
+
+@lru_cache
+def compile_clip(rule):
+   """
+   Validates and compiles the clip rule of a site (once per process), either the bounding box of an element ({selector})
+   or x,y,width,height as arithmetic expressions of numbers and bounding box values of elements, e.g. {#svgBox}.y - {#headerBox}.height.
+   Returns the selectors of the elements and the code objects of the four expressions (None for the bounding box of an element).
+   """
+   if match := re.fullmatch(r"\s*\{([^{}]+)\}\s*", rule):
+      return (match.group(1).strip(),), None
+   selectors = []
+   def variable(match):
+      """
+      Replaces an element's bounding box value by a variable, e.g. b0_height.
+      """
+      if match.group(2) is None: raise ValueError(f"Clip rule {rule}: {match.group(0)} needs .x, .y, .width or .height")
+      selector = match.group(1).strip()
+      if selector not in selectors: selectors.append(selector)
+      return f"b{selectors.index(selector)}_{match.group(2)}"
+   expressions = clip_terms.sub(variable, rule).split(",")
+   if len(expressions) != 4: raise ValueError(f"Clip rule {rule} needs x,y,width,height or {{selector}}")
+   codes = []
+   for expression in expressions:
+      try:
+         tree = ast.parse(expression.strip(), mode="eval")
+      except SyntaxError:
+         raise ValueError(f"Clip rule {rule}: invalid expression {expression.strip()}")
+      variables = { f"b{i}_{field}" for i in range(len(selectors)) for field in box_fields }
+      if not all(
+         isinstance(node, clip_nodes)
+         and (not isinstance(node, ast.Constant) or type(node.value) in (int, float))
+         and (not isinstance(node, ast.Name) or node.id in variables)
+         for node in ast.walk(tree)
+      ):
+         raise ValueError(f"Clip rule {rule}: only numbers, + - * / and bounding box values are allowed in {expression.strip()}")
+      codes.append(compile(tree, "<clip>", "eval"))
+   return tuple(selectors), tuple(codes)
+
+
+async def site_clip(page, rule):
+   """
+   Evaluates the clip rule of a site on the loaded page.
+   Returns the clip, or None if one of its elements is not visible.
+   """
+   selectors, codes = compile_clip(rule)
+   boxes = [ await page.locator(selector).first.bounding_box() for selector in selectors ]
+   if None in boxes: return
+   if codes is None: return boxes[0]
+   values = { f"b{i}_{field}": box[field] for i, box in enumerate(boxes) for field in box_fields }
+   return dict(zip(box_fields, ( eval(code, {"__builtins__": {}}, values) for code in codes )))
+
+
+def page_options(site, args):
+   """
+   Returns the options of the browser context of a site: the user agent and, if the site needs a login, the credentials
+   (its own ones or the username and password options).
+   """
+   options = { "user_agent": args.user_agent }
+   entry   = args.site_registry[site]
+   if entry["login"]:
+      options["http_credentials"] = {"username": entry["username"] or args.username, "password": entry["password"] or args.password}
+   return options
+
+
+async def load_page(page, target, dt_utc, args, logger, timer):
+   """
+   Loads the URL of the target in the page (filled with the datetime, if the site has a time URL)
+   and waits for the wait selectors and the readiness of the site.
+   Returns True if the page is ready for the screenshot.
+   """
+   site     = target["site"]
+   entry    = args.site_registry[site]
+   URL      = metmaps_url(target["url"], dt_utc) if entry["time_url"] else target["url"]
+   
+   # try to go to the URL
+   try:
+      with timer.phase("goto"):
+         await page.goto(URL, wait_until=goto_wait(site, args))
+   # if an error occurs, handle it
+   except Exception as e:
+      log_exception(e, args, logger)
+      return False
+   
+   # wait for the map to be fully loaded
+   try:
+      with timer.phase("ready"):
+         for selector in entry["wait"]:
+            await page.wait_for_selector(selector)
+         # wait until the page is ready (load state or DOM quiescence, as configured for the site)
+         await wait_ready(page, site, args, logger)
+   # if an error occurs, handle it
+   except Exception as e:
+      log_exception(e, args, logger)
+      return False
+   return True
+
+
+async def clip_screenshot(page, target, args, logger, timer):
+   """
+   Takes a screenshot of the target's clip (or the site's clip rule) of the loaded page.
+   Returns the PNG bytes, or None if the clip could not be found.
+   """
+   entry = args.site_registry[target["site"]]
+   
+   # try to get the clip of the target
+   try:
+      clip = target["clip"] or await site_clip(page, entry["clip"])
+   # if an error occurs, handle it
+   except Exception as e:
+      log_exception(e, args, logger)
+      return
+   if clip is None:
+      logger.warning(f"Clip of target {target['name']} not found: {entry['clip']}")
+      return
+   
+   # take a screenshot of the clip into memory
+   with timer.phase("screenshot"):
+      return await page.screenshot(clip=clip)
+
+
+async def site_screenshot(page, target, dt_utc, args, logger, timer):
+   """
+   Loads the page of the target and takes a screenshot of its clip.
+   Returns the PNG bytes, or None if the page could not be loaded.
+   """
+   if await load_page(page, target, dt_utc, args, logger, timer):
+      return await clip_screenshot(page, target, args, logger, timer)
+
+
+async def content_fingerprint(page, selector, timer):
+   """
+   Returns a hash of the markup of the site's fingerprint element (e.g. the SVG of the warnings), or None if it is missing.
+   Hashing the markup is much cheaper than rendering, clipping and encoding a screenshot.
+   """
+   with timer.phase("fingerprint"):
+      markup = await page.evaluate("selector => document.querySelector(selector)?.outerHTML ?? null", selector)
+   if markup is None: return
+   return hashlib.sha256(markup.encode()).hexdigest()[:32]
+
+
+def unchanged(fingerprint, since, dt_utc, args):
+   """
+   Returns True if the content fingerprint is the one of the target's last frame (since = fingerprint and datetime of the
+   last frame) and the heartbeat doesn't force a new frame yet.
+   """
+   if fingerprint is None or since is None or fingerprint != since[0]: return False
+   return not args.heartbeat or dt_utc - since[1] < td(minutes=args.heartbeat)
+
+
+# serializes the vector element of a site (e.g. the SVG map) with its computed styles inlined, as the stylesheets of the page
+# are not part of the SVG, and gets the text, size and colors of the header element (if given)
+vector_script = """([vectorSelector, headerSelector]) => {
+   const element    = document.querySelector(vectorSelector);
+   if (!element) return null;
+   const box        = element.getBoundingClientRect();
+   const clone      = element.cloneNode(true);
+   const originals  = [element, ...element.querySelectorAll("*")];
+   const copies     = [clone, ...clone.querySelectorAll("*")];
+   const properties = ["fill", "fill-opacity", "fill-rule", "stroke", "stroke-width", "stroke-opacity", "stroke-linejoin", "opacity", "display", "visibility", "font-family", "font-size", "font-weight"];
+   originals.forEach((original, i) => {
+      const style = getComputedStyle(original);
+      copies[i].setAttribute("style", properties.map(property => `${property}:${style.getPropertyValue(property)}`).join(";"));
+   });
+   clone.setAttribute("width", box.width);
+   clone.setAttribute("height", box.height);
+   const header     = headerSelector ? document.querySelector(headerSelector) : null;
+   const style      = header ? getComputedStyle(header) : null;
+   return {
+      svg:        new XMLSerializer().serializeToString(clone),
+      width:      box.width,
+      height:     box.height,
+      header:     header ? header.innerText.trim() : "",
+      headerHeight: header ? header.getBoundingClientRect().height : 0,
+      background: style ? style.backgroundColor : "none",
+      color:      style ? style.color : "black",
+      fontSize:   style ? parseFloat(style.fontSize) : 16
+   };
+}"""
+
+
+def vector_document(vector, dt_utc, position):
+   """
+   Composes the standalone SVG document of a vector frame: the header band above the map and (if position is given)
+   the datetime watermark, placed like the watermark of the raster frames. Returns it gzip-compressed (.svgz).
+   """
+   header_h = vector["headerHeight"]
+   w, h     = vector["width"], header_h + vector["height"]
+   parts    = [ f'<svg xmlns="http://www.w3.org/2000/svg" width="{w:g}" height="{h:g}" viewBox="0 0 {w:g} {h:g}">' ]
+   # the header band with its text
+   if header_h:
+      parts.append(f'<rect width="{w:g}" height="{header_h:g}" fill="{vector["background"]}"/>')
+      parts.append(f'<text x="8" y="{header_h / 2 + vector["fontSize"] * 0.35:g}" fill="{vector["color"]}" font-family="sans-serif" font-size="{vector["fontSize"]:g}">{escape(vector["header"])}</text>')
+   # the map below the header
+   parts.append(f'<g transform="translate(0,{header_h:g})">{vector["svg"]}</g>')
+   # the watermark, scaling with the resolution of the raster images
+   if position is not None:
+      x, font_size = (w / 4, h / 18) if position == "bl" else (w - w / 5, w / 20)
+      parts.append(f'<text x="{x:g}" y="{h - h / 50:g}" fill="red" font-family="sans-serif" font-size="{font_size:g}" text-anchor="middle">{dt_minutes_mark(dt_utc)}</text>')
+   parts.append("</svg>")
+   return gzip.compress("".join(parts).encode(), compresslevel=9, mtime=0)
+
+
+async def extract_vector(page, target, dt_utc, args, logger, timer):
+   """
+   Extracts the vector map of the site (and its header) from the loaded page, once per tick.
+   Returns the compressed SVG document, or None if the vector element is missing.
+   """
+   entry = args.site_registry[target["site"]]
+   with timer.phase("vector"):
+      vector = await page.evaluate(vector_script, [entry["vector"], entry["vector_header"]])
+   if vector is None:
+      logger.warning(f"Vector element of target {target['name']} not found: {entry['vector']}")
+      return
+   return vector_document(vector, dt_utc, target["position"] if args.watermark else None)
+
+
+async def capture_site(args, dt_utc, logger, browsers, timer, target, since=None):
+   """
+   Takes the screenshots of a target with the definition of its site from the site registry:
+   the target's clip, its extra regions and (if desired) the vector map of the site, all from one page load.
+   In change-driven mode the screenshots are only taken if the content fingerprint of the site changed since the
+   target's last frame (since = its fingerprint and datetime) or the heartbeat is due.
+   Returns the captured frames (none if unchanged) and the content fingerprint, or None if the page could not be loaded.
+   """
+   site        = target["site"]
+   entry       = args.site_registry[site]
+   selector    = entry["fingerprint"]
+   fingerprint = None
+   
+   # use a fresh context (with the credentials, if the site needs a login) of the warm browser
+   async with browsers.new_page(timer, **page_options(site, args)) as page:
+      
+      # block unneeded requests and serve static assets from the cache (as configured for the site) and count them
+      requests = await route_requests(page, args.request_filters[site], browsers.cache, args.metrics)
+      
+      # load the page
+      if not await load_page(page, target, dt_utc, args, logger, timer): return
+      
+      # skip the rendering if the content of the page didn't change since the last frame (if change-driven)
+      if args.change_driven and selector:
+         fingerprint = await content_fingerprint(page, selector, timer)
+         if unchanged(fingerprint, since, dt_utc, args):
+            log_requests(site, requests, args, logger)
+            return [], fingerprint
+      
+      # take a screenshot of the target's clip into memory
+      data = await clip_screenshot(page, target, args, logger, timer)
+      if data is None: return
+      
+      # take screenshots of the extra regions of the target from the same loaded page
+      regions = await region_frames(page, target, args, logger, timer)
+      
+      # extract the vector map of the site (if desired), which is rasterized offline at any resolution
+      if args.vector and entry["vector"]:
+         if (vector := await extract_vector(page, target, dt_utc, args, logger, timer)) is not None:
+            regions.append((f"{target['name']}_vector", vector, target["position"]))
+      
+      # print (if verbose) and log the blocked and loaded requests
+      log_requests(site, requests, args, logger)
+   
+   # return the frame names, the captured images and the positions of the watermarks, and the content fingerprint
+   return [(target["name"], data, target["position"])] + regions, fingerprint
+
+
+async def region_frames(page, target, args, logger, timer):
+   """
+   Takes a screenshot of every extra region of the target from the already loaded page,
+   either of a fixed clip or of the bounding box of the region's selector.
+   Returns the frames (name, PNG bytes, watermark position); regions which cannot be found are left out.
+   """
+   frames = []
+   for region in target["regions"]:
+      # try to get the clip of the region
+      try:
+         clip = region["clip"] or await page.locator(region["selector"]).first.bounding_box()
+      # if an error occurs, handle it and go on with the next region
+      except Exception as e:
+         log_exception(e, args, logger)
+         continue
+      # the element of the selector is not visible
+      if clip is None:
+         logger.warning(f"Region {region['name']} of target {target['name']} not found: {region['selector']}")
+         continue
+      # take a screenshot of the region into memory
+      with timer.phase("screenshot"):
+         data = await page.screenshot(clip=clip)
+      frames.append((region["name"], data, region["position"]))
+   return frames
+
+
+class BrowserManager:
+   """
+   Keeps one browser running across captures and hands out a fresh context per capture.
+   The browser is only relaunched after a crash or after max_uses captures (0 = never).
+   The optional HTTP cache is shared by all pages of the browser.
+   """
+   def __init__(self, browser_name, timeout, max_uses=0, cache=None):
+      self.browser_name = browser_name
+      self.timeout      = timeout
+      self.max_uses     = max_uses
+      self.cache        = cache
+      self.playwright   = None
+      self.browser      = None
+      self.uses         = 0
+      # number of open contexts per browser and browsers which are closed after their last context
+      self.active       = {}
+      self.retired      = set()
+      self.lock         = asyncio.Lock()
+   
+   async def get_browser(self, timer=None):
+      """
+      Returns the running browser, (re)launching it if necessary (timed as launch phase).
+      """
+      # only one capture at a time may (re)launch the browser
+      async with self.lock:
+         # start playwright only once per process
+         if self.playwright is None:
+            self.playwright = await async_playwright().start()
+         # relaunch the browser if it crashed or has been used too often
+         if self.browser is not None:
+            if not self.browser.is_connected() or (self.max_uses and self.uses >= self.max_uses):
+               await self.retire()
+         # launch the browser if it is not running (yet)
+         if self.browser is None:
+            started        = perf_counter()
+            self.browser   = await launch_browser(self.playwright, self.browser_name)
+            self.uses      = 0
+            if timer is not None: timer.add("launch", perf_counter() - started)
+         self.uses += 1
+         return self.browser
+   
+   @asynccontextmanager
+   async def new_page(self, timer=None, **context_options):
+      """
+      Yields a page in a fresh browser context, which is closed again afterwards.
+      Launching the browser and creating the context are timed with the (optional) capture timer.
+      """
+      async with self.new_context(timer, **context_options) as context:
+         started  = perf_counter()
+         page     = await context.new_page()
+         if timer is not None: timer.add("context", perf_counter() - started)
+         yield page
+   
+   @asynccontextmanager
+   async def new_context(self, timer=None, **context_options):
+      """
+      Yields a fresh browser context (e.g. for several pages with the same credentials), which is closed again afterwards.
+      """
+      browser  = await self.get_browser(timer)
+      context  = None
+      self.active[browser] = self.active.get(browser, 0) + 1
+      try:
+         started = perf_counter()
+         # create a new browser context with the given options (user agent, credentials, ...)
+         context = await browser.new_context(**context_options)
+         # set the default timeout for the context
+         context.set_default_timeout(self.timeout)
+         if timer is not None: timer.add("context", perf_counter() - started)
+         yield context
+      finally:
+         # if we can't close the context, the browser is probably broken, so we relaunch it next time
+         try:
+            if context is not None: await context.close()
+         except Exception:
+            if browser is self.browser: await self.retire()
+         await self.release(browser)
+   
+   async def retire(self):
+      """
+      Takes the current browser out of service, it is closed as soon as its last capture is done.
+      """
+      browser, self.browser = self.browser, None
+      if browser is None: return
+      if self.active.get(browser):
+         self.retired.add(browser)
+      else:
+         await self.close_browser(browser)
+   
+   async def release(self, browser):
+      """
+      Marks one capture of the browser as done and closes a retired browser after its last capture.
+      """
+      self.active[browser] -= 1
+      if not self.active[browser]:
+         del self.active[browser]
+         if browser in self.retired:
+            self.retired.discard(browser)
+            await self.close_browser(browser)
+   
+   @staticmethod
+   async def close_browser(browser):
+      """
+      Closes a browser, ignoring errors of already crashed browsers.
+      """
+      try:
+         await browser.close()
+      except Exception: pass
+   
+   async def close(self):
+      """
+      Closes all browsers and stops playwright.
+      """
+      await self.retire()
+      for browser in self.retired:
+         await self.close_browser(browser)
+      self.retired.clear()
+      if self.playwright is not None:
+         await self.playwright.stop()
+         self.playwright = None
+      if self.cache is not None: self.cache.close()
+
+
+# the watermark positions
+watermark_positions = { "bl", "br" }
+
+
+def load_sites(config, urls={}):
+   """
+   Loads the site registry: the [sites] section maps the site letters to the config sections of the site definitions.
+   Each definition has the URL of the page, whether it needs a login (with its own credentials login_username and login_password,
+   default: the username and password options), whether the datetime is filled into the URL (time_url),
+   the selectors to wait for, the readiness strategy (with its selector, quiet period and maximum wait), the clip rule, the watermark position and the fingerprint selector
+   (the element whose markup shows whether the content changed, for change-driven capture)
+   and the vector selectors (the SVG map and its header, for the vector export).
+   The definitions are validated and their clip rules compiled once at startup, so adding a site is a config change.
+   The URLs of sites given in urls replace the configured ones (e.g. the URL option or local stand-in pages).
+   Returns the site definitions by letter.
+   """
+   registry = {}
+   for site, section in config.items("sites"):
+      if len(site) != 1 or site == "a": raise ValueError(f"Site {site}: the key of a site has to be a single letter other than a")
+      if not config.has_section(section): raise ValueError(f"Site {site}: config section [{section}] is missing")
+      entry = {
+         "name":     section,
+         "url":      urls.get(site) or config.get(section, "url", fallback=""),
+         "time_url": config.getboolean(section, "time_url", fallback=False),
+         "login":    config.getboolean(section, "login", fallback=False),
+         "username": config.get(section, "login_username", fallback=""),
+         "password": config.get(section, "login_password", fallback=""),
+         "wait":     [ selector.strip() for selector in config.get(section, "wait_selectors", fallback="").split(",") if selector.strip() ],
+         "clip":     config.get(section, "clip", fallback=""),
+         "position": config.get(section, "position", fallback="br"),
+         "fingerprint": config.get(section, "fingerprint", fallback=""),
+         "vector":   config.get(section, "vector", fallback=""),
+         "vector_header": config.get(section, "vector_header", fallback="")
+      }
+      if not entry["url"]: raise ValueError(f"Site {site}: [{section}] has no url")
+      if not entry["clip"]: raise ValueError(f"Site {site}: [{section}] has no clip rule")
+      if entry["position"] not in watermark_positions: raise ValueError(f"Site {site}: unknown watermark position {entry['position']}, choose from {', '.join(sorted(watermark_positions))}")
+      entry["readiness"] = { "strategy": config.get(section, "readiness", fallback="load"), "selector": config.get(section, "quiet_selector", fallback="body") }
+      if entry["readiness"]["strategy"] not in {"load", "quiet"}: raise ValueError(f"Site {site}: readiness has to be load or quiet")
+      for option, fallback in (("quiet_ms", 500), ("max_wait", 10)):
+         try:
+            entry["readiness"][option] = config.getint(section, option, fallback=fallback)
+         except ValueError:
+            raise ValueError(f"Site {site}: {option} has to be a whole number, not {config.get(section, option)}") from None
+         if entry["readiness"][option] <= 0: raise ValueError(f"Site {site}: {option} has to be positive")
+      compile_clip(entry["clip"])
+      registry[site] = entry
+   return registry
+
+
+def site_target(site, args):
+   """
+   Returns the default target of a site: its frame name, URL, clip (None = the clip rule of the site), watermark position
+   and extra regions (captured from the same page load, see config_regions).
+   """
+   return {
+      "site":     site,
+      "name":     args.site_registry[site]["name"],
+      "url":      args.site_registry[site]["url"],
+      "clip":     None,
+      "position": args.site_registry[site]["position"],
+      "regions":  []
+   }
+
+
+def config_targets(config, args):
+   """
+   Returns the targets of the [target.NAME] sections of the config by name, e.g. several metmaps views.
+   Each target has a site (a letter of the site registry) and optionally its own url, clip (x,y,width,height) and watermark position (bl or br).
+   """
+   targets = {}
+   for section in config.sections():
+      if not section.startswith("target."): continue
+      name     = section.split(".", 1)[1]
+      site     = config.get(section, "site")
+      if site not in args.site_registry: raise ValueError(f"Target {name} has unknown site {site}, choose from {', '.join(args.site_registry)}")
+      target   = site_target(site, args) | { "name": name }
+      if url := config.get(section, "url", fallback=""): target["url"] = url
+      if clip := config.get(section, "clip", fallback=""):
+         target["clip"] = parse_clip(clip)
+      target["position"] = config.get(section, "position", fallback=target["position"])
+      targets[name] = target
+   return targets
+
+
+def parse_clip(clip):
+   """
+   Parses a clip given as x,y,width,height.
+   """
+   return dict(zip(("x", "y", "width", "height"), map(float, clip.split(","))))
+
+
+def config_regions(config, targets, known):
+   """
+   Adds the extra regions of the [region.NAME] sections of the config to their targets (a site letter or a target name).
+   Each region has its own frame name, a clip (x,y,width,height) or a selector and a watermark position (default: the target's).
+   All regions of a target are captured from one page load. Regions of known targets which are not captured are ignored,
+   a region of an unknown target (e.g. a typo) is an error.
+   """
+   for section in config.sections():
+      if not section.startswith("region."): continue
+      name     = section.split(".", 1)[1]
+      key      = config.get(section, "target")
+      if key not in known: raise ValueError(f"Region {name} has an unknown target {key}, known are: {', '.join(sorted(known))}")
+      if key not in targets: continue
+      target   = targets[key]
+      clip     = config.get(section, "clip", fallback="")
+      selector = config.get(section, "selector", fallback="")
+      if not (clip or selector): raise ValueError(f"Region {name} needs a clip or a selector")
+      target["regions"].append({
+         "name":     name,
+         "clip":     parse_clip(clip) if clip else None,
+         "selector": selector,
+         "position": config.get(section, "position", fallback=target["position"])
+      })
+
+
+class RequestFilter:
+   """
+   Decides which requests of a site are blocked: by resource type (e.g. font, media, image)
+   or by URL pattern (with * and ? wildcards), unless the URL matches one of the allow patterns.
+   Requests matching the live patterns are never served from the HTTP cache.
+   """
+   def __init__(self, block_types="", block_urls="", allow_urls="", live_urls=""):
+      self.block_types  = { t.strip() for t in block_types.split(",") if t.strip() }
+      self.block_urls   = [ p.strip() for p in block_urls.split(",") if p.strip() ]
+      self.allow_urls   = [ p.strip() for p in allow_urls.split(",") if p.strip() ]
+      self.live_urls    = [ p.strip() for p in live_urls.split(",") if p.strip() ]
+   
+   def __bool__(self):
+      return bool(self.block_types or self.block_urls)
+   
+   def blocked(self, request):
+      """
+      Returns True if the request should be blocked.
+      """
+      if any(fnmatchcase(request.url, pattern) for pattern in self.allow_urls):
+         return False
+      return request.resource_type in self.block_types or any(fnmatchcase(request.url, pattern) for pattern in self.block_urls)
+   
+   def live(self, request):
+      """
+      Returns True if the request must always be fetched live.
+      """
+      return any(fnmatchcase(request.url, pattern) for pattern in self.live_urls)
+
+
+class HttpCache:
+   """
+   On-disk cache of static assets and map tiles, shared by all capture processes and kept across runs.
+   Only successful GET requests of the cached resource types are stored, except for URLs matching a live pattern.
+   Entries expire after cache_ttl seconds and the least recently used entries are evicted above cache_max_size MB.
+   The index is a SQLite database, the bodies are files named by the hash of their URL.
+   The route handlers use lookup and store, which run the disk I/O in one thread, so it never blocks the event loop.
+   The last use of the entries is written in batches (before evicting and on close), not with every hit.
+   """
+   # headers which don't apply to the decoded, cached body anymore
+   dropped_headers = { "content-encoding", "content-length", "transfer-encoding" }
+   # number of hits after which their times of use are written
+   used_batch      = 100
+   
+   def __init__(self, args):
+      self.args      = args
+      self.dir       = Path(args.cache_dir)
+      self.dir.mkdir(parents=True, exist_ok=True)
+      self.types     = { t.strip() for t in args.cache_types.split(",") if t.strip() }
+      self.live_urls = [ p.strip() for p in args.cache_live_urls.split(",") if p.strip() ]
+      self.max_size  = args.cache_max_size * 1024 * 1024
+      # the connection is only used by the cache thread (one at a time)
+      self.db        = sqlite3.connect(self.dir / "index.sqlite", timeout=30, check_same_thread=False)
+      self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, status INTEGER, headers TEXT, size INTEGER, expires REAL, used REAL)")
+      self.db.commit()
+      self.executor  = ThreadPoolExecutor(max_workers=1)
+      # key -> time of the last use, not written yet
+      self.used      = {}
+   
+   def cacheable(self, request, request_filter):
+      """
+      Returns True if the request may be served from (and stored in) the cache.
+      """
+      return (request.method == "GET" and request.resource_type in self.types
+         and not request_filter.live(request) and not any(fnmatchcase(request.url, p) for p in self.live_urls))
+   
+   @staticmethod
+   def key(url):
+      """
+      Returns the key of a URL, which is also the file name of its body.
+      """
+      return hashlib.sha256(url.encode()).hexdigest()
+   
+   def get(self, url):
+      """
+      Returns (status, headers, body) of a fresh cached response, or None.
+      """
+      key   = self.key(url)
+      row   = self.db.execute("SELECT status, headers FROM entries WHERE key = ? AND expires > ?", (key, time())).fetchone()
+      if row is None: return None
+      try:
+         body = (self.dir / key).read_bytes()
+      except OSError:
+         return None
+      self.used[key] = time()
+      if len(self.used) >= self.used_batch: self.write_used()
+      return row[0], json.loads(row[1]), body
+   
+   def write_used(self):
+      """
+      Writes the times of use of the last hits to the index.
+      """
+      if not self.used: return
+      self.db.executemany("UPDATE entries SET used = ? WHERE key = ?", [ (used, key) for key, used in self.used.items() ])
+      self.db.commit()
+      self.used.clear()
+   
+   def put(self, url, status, headers, body):
+      """
+      Stores a response and evicts the least recently used entries if the cache got too large.
+      """
+      key      = self.key(url)
+      headers  = { k: v for k, v in headers.items() if k.lower() not in self.dropped_headers }
+      write_atomic(self.dir / key, body)
+      self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)", (key, status, json.dumps(headers), len(body), time() + self.args.cache_ttl, time()))
+      # evict the least recently used entries (and expired ones first, as they are useless anyway)
+      size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+      if size > self.max_size:
+         # evict by the current times of use
+         self.write_used()
+         for old_key, old_size in self.db.execute("SELECT key, size FROM entries ORDER BY expires > ?, used", (time(),)).fetchall():
+            if size <= self.max_size: break
+            self.db.execute("DELETE FROM entries WHERE key = ?", (old_key,))
+            (self.dir / old_key).unlink(missing_ok=True)
+            size -= old_size
+      self.db.commit()
+   
+   async def lookup(self, url):
+      """
+      Returns (status, headers, body) of a fresh cached response, or None, reading it in the cache thread.
+      """
+      return await asyncio.get_running_loop().run_in_executor(self.executor, self.get, url)
+   
+   async def store(self, url, status, headers, body):
+      """
+      Stores a response in the cache thread.
+      """
+      await asyncio.get_running_loop().run_in_executor(self.executor, self.put, url, status, headers, body)
+   
+   def close(self):
+      """
+      Writes the last times of use and closes the index database.
+      """
+      self.executor.shutdown()
+      self.write_used()
+      self.db.close()
+
+
+async def route_requests(page, request_filter, cache=None, measure=False):
+   """
+   Routes the requests of the page through the request filter (if it blocks anything) and the HTTP cache (if any).
+   Returns the counters of blocked requests (per resource type), cached requests and loaded requests and bytes,
+   updated while the page loads. The loaded bytes cost a round trip per request, so they are only counted
+   with a request filter, a cache or metrics (measure).
+   """
+   requests = { "blocked": 0, "blocked_types": {}, "cached": 0, "loaded": 0, "bytes": 0 }
+   
+   async def route(route):
+      request = route.request
+      # abort blocked requests
+      if request_filter.blocked(request):
+         requests["blocked"] += 1
+         requests["blocked_types"][request.resource_type] = requests["blocked_types"].get(request.resource_type, 0) + 1
+         await route.abort("blockedbyclient")
+      # serve cacheable requests from the cache or fetch and store them
+      elif cache is not None and cache.cacheable(request, request_filter):
+         if (cached := await cache.lookup(request.url)) is not None:
+            requests["cached"] += 1
+            status, headers, body = cached
+            await route.fulfill(status=status, headers=headers, body=body)
+         else:
+            try:
+               response = await route.fetch()
+               body     = await response.body()
+            # let the browser load the request itself, so a failing upstream fails like without the cache (instead of hanging)
+            except Exception:
+               await route.continue_()
+               return
+            await route.fulfill(response=response, body=body)
+            if response.status == 200: await cache.store(request.url, response.status, response.headers, body)
+      # let all others continue
+      else:
+         await route.continue_()
+   
+   async def finished(request):
+      # count the transferred bytes of the loaded requests
+      try:
+         sizes = await request.sizes()
+         requests["loaded"] += 1
+         requests["bytes"]  += sizes["responseHeadersSize"] + sizes["responseBodySize"]
+      except Exception: pass
+   
+   if request_filter or cache is not None: await page.route("**/*", route)
+   if request_filter or cache is not None or measure: page.on("requestfinished", finished)
+   return requests
+
+
+# resolves after the target element (and its images) had no changes for quietMs, or with false after maxMs
+quiet_script = """([selector, quietMs, maxMs]) => new Promise(resolve => {
+   const target   = document.querySelector(selector) || document.body;
+   // images and image buttons (input type=image, e.g. the map of metmaps), including the target itself
+   const isImage  = el => el.tagName === "IMG" || (el.tagName === "INPUT" && el.type === "image");
+   const images   = () => [...target.querySelectorAll("img, input[type=image]"), ...(isImage(target) ? [target] : [])];
+   // image buttons have no complete flag: they are loaded after their load (or error) event for the current source
+   // or if the resource timing has a finished entry of their source (loaded before this script ran)
+   const loaded   = new WeakMap();
+   const complete = el => el.tagName === "IMG" ? el.complete : !el.src || loaded.get(el) === el.src || performance.getEntriesByName(el.src).length > 0;
+   let timer;
+   const done     = quiet => { observer.disconnect(); clearTimeout(timer); clearTimeout(limit); resolve(quiet); };
+   // (re)start the quiet period, it only ends when all images are loaded
+   const arm      = () => { clearTimeout(timer); timer = setTimeout(() => images().some(img => !complete(img)) ? arm() : done(true), quietMs); };
+   const settle   = event => { if (isImage(event.target)) loaded.set(event.target, event.target.src); arm(); };
+   const observer = new MutationObserver(arm);
+   observer.observe(target, { subtree: true, childList: true, attributes: true, characterData: true });
+   target.addEventListener("load", settle, true);
+   target.addEventListener("error", settle, true);
+   const limit    = setTimeout(() => done(false), maxMs);
+   arm();
+})"""
+
+
+def goto_wait(site, args):
+   """
+   Returns the load state page.goto waits for: with the quiet strategy only the DOM, as it waits for the target element itself.
+   """
+   return "domcontentloaded" if args.readiness[site]["strategy"] == "quiet" else "load"
+
+
+async def wait_ready(page, site, args, logger):
+   """
+   Waits until the page of the site is ready for the screenshot, using the site's readiness strategy:
+   load -> wait for the load state (or network idle if network_idle is True),
+   quiet -> wait until the target element had no DOM or image changes for quiet_ms (at most max_wait seconds).
+   """
+   readiness = args.readiness[site]
+   if readiness["strategy"] == "quiet":
+      await page.wait_for_selector(readiness["selector"])
+      quiet = await page.evaluate(quiet_script, [readiness["selector"], readiness["quiet_ms"], readiness["max_wait"] * 1000])
+      # take the screenshot anyway, but note that the page didn't get quiet
+      if not quiet:
+         message = f"{site}: {readiness['selector']} not quiet after {readiness['max_wait']}s"
+         if args.verbose: print(message)
+         logger.info(f"{message}")
+   # if network_idle is True, wait for the network to be idle
+   elif args.network_idle:
+      await page.wait_for_load_state('networkidle')
+   # else just wait for the correct load state
+   else: await page.wait_for_load_state('load')
+
+
+def log_requests(site, requests, args, logger):
+   """
+   Prints (if verbose) and logs the blocked and loaded requests of a capture.
+   """
+   blocked_types  = ", ".join(f"{k} {v}" for k, v in requests["blocked_types"].items())
+   message        = f"Requests of {site}: blocked {requests['blocked']} ({blocked_types}), from cache {requests['cached']}, loaded {requests['loaded']} ({requests['bytes']} bytes)"
+   if args.verbose: print(message)
+   logger.info(f"{message}")
+
+
+def log_exception(e, args, logger):
+   """
+   Prints and/or logs an exception with its traceback, depending on verbose and log settings.
+   """
+   if args.verbose:
+      print(e)
+      traceback.print_exc()
+   if args.log: logger.error(f"{e.__class__.__name__}: {e}", exc_info=e, extra={"phase": getattr(e, "phase", None)})
+
+
+# structured fields of the log records of the current capture task (site, tick and the phase entered last)
+log_fields = contextvars.ContextVar("log_fields", default={})
+# queue to the log writer process, handed to the capture processes (set in the main process if logging is turned on)
+log_queue  = None
+
+
+class JsonFormatter(logging.Formatter):
+   """
+   Formats a log record as a JSON line with its time, level, process and message,
+   the structured fields of the capture (if any) and the traceback of an exception.
+   """
+   fields = ("site", "tick", "phase", "duration", "outcome", "phases", "exception")
+   
+   def format(self, record):
+      entry = {
+         "time":     dt.fromtimestamp(record.created, tz.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+         "level":    record.levelname,
+         "process":  record.processName,
+         "message":  record.getMessage()
+      }
+      if record.exc_info: record.exception = self.formatException(record.exc_info)
+      entry.update((field, value) for field in self.fields if (value := getattr(record, field, None)) is not None)
+      return json.dumps(entry, default=str)
+
+
+class LogQueueHandler(QueueHandler):
+   """
+   Sends the log records of a process to the log writer process without waiting for the log file,
+   with the structured fields of the current capture task and the traceback formatted in this process.
+   """
+   def prepare(self, record):
+      record = copy.copy(record)
+      for field, value in log_fields.get().items():
+         if not hasattr(record, field): setattr(record, field, value)
+      if record.exc_info: record.exception = logging.Formatter().formatException(record.exc_info)
+      # the arguments and the exception may not be picklable, so only the message and the traceback text are sent
+      record.msg        = record.getMessage()
+      record.args       = None
+      record.exc_info   = None
+      record.exc_text   = None
+      return record
+
+
+def log_writer(queue, args):
+   """
+   Runs in the log writer process: writes the log records of all processes from the queue as JSON lines,
+   rotating the log file by size (log_max_mb) or by time (log_rotate), until it receives None.
+   """
+   # the main process stops the writer after the last record, so Ctrl+C must not kill it before
+   signal.signal(signal.SIGINT, signal.SIG_IGN)
+   if args.log_rotate:
+      handler = TimedRotatingFileHandler(args.log_file, when=args.log_rotate, backupCount=args.log_backups, encoding="utf-8", utc=True)
+   else:
+      handler = RotatingFileHandler(args.log_file, maxBytes=args.log_max_mb * 1024**2, backupCount=args.log_backups, encoding="utf-8")
+   handler.setFormatter(JsonFormatter())
+   try:
+      while (record := queue.get()) is not None:
+         handler.handle(record)
+   finally:
+      handler.close()
+
+
+class LogWriter:
+   """
+   Handle for the log writer process, which is the only one writing the log file.
+   """
+   def __init__(self, args):
+      self.args      = args
+      self.queue     = Queue()
+      self.process   = Process(target=log_writer, args=(self.queue, args), name="log-writer", daemon=True)
+   
+   def start(self):
+      """
+      Starts the log writer process and stops it at exit (after the last record).
+      """
+      self.process.start()
+      atexit.register(self.stop)
+   
+   def stop(self):
+      """
+      Lets the log writer process write the remaining records and waits for it.
+      """
+      if self.process.is_alive():
+         self.queue.put(None)
+         self.process.join(timeout=5)
+
+
+def configure_logging(queue, args):
+   """
+   Configures the logging of a process: its records go through the queue to the log writer process (if logging is turned on).
+   Replaces the handlers inherited from the main process, so a forked capture process does not write to the log file itself.
+   """
+   root = logging.getLogger()
+   for handler in root.handlers[:]: root.removeHandler(handler)
+   if queue is not None: root.addHandler(LogQueueHandler(queue))
+   # if logging is turned off: only log critical (effectively nothing)
+   root.setLevel(logging.INFO if args.log else logging.CRITICAL)
+
+
+class CaptureTimer:
+   """
+   Measures the durations of the phases of one capture in seconds (summed up if a phase occurs more than once).
+   """
+   def __init__(self):
+      self.phases    = {}
+      self.started   = perf_counter()
+      self.attempts  = 0
+      self.lock      = threading.Lock()
+   
+   @contextmanager
+   def phase(self, name):
+      """
+      Times the block as the given phase (and names it in the log records of the capture while it runs).
+      An exception raised in the phase keeps its name (the innermost one), so it is logged with it later.
+      """
+      if fields := log_fields.get(): fields["phase"] = name
+      started = perf_counter()
+      try:
+         yield
+      except Exception as e:
+         if not hasattr(e, "phase"): e.phase = name
+         raise
+      finally:
+         # later log records of the capture don't belong to this phase anymore
+         if fields: fields.pop("phase", None)
+         self.add(name, perf_counter() - started)
+   
+   def add(self, name, seconds):
+      """
+      Adds a duration to a phase (the encoder threads of several frames may add at the same time).
+      """
+      with self.lock:
+         self.phases[name] = self.phases.get(name, 0.0) + seconds
+   
+   def record(self, site, browser, outcome, dt_utc):
+      """
+      Returns the metrics record of the capture, labeled by site, browser and outcome.
+      """
+      return {
+         "time":     dt_utc.strftime("%Y-%m-%dT%H:%M:%SZ"),
+         "site":     site,
+         "browser":  browser,
+         "outcome":  outcome,
+         "attempts": self.attempts,
+         "total":    round(perf_counter() - self.started, 4),
+         "phases":   { phase: round(seconds, 4) for phase, seconds in self.phases.items() }
+      }
+
+
+async def capture(job_id, key, dt_utc, probe, since, args, browsers, limit, encoder, store, dedup, animator, results, logger):
+   """
+   Takes one screenshot of a target (given by its key), waiting for a free slot of the target's concurrency limit.
+   The capture is cancelled after capture_deadline seconds and its browser gets relaunched.
+   A failed capture is retried (after a jittered exponential backoff) as long as the retry can finish before the next tick,
+   a probe (sent while the site's circuit breaker is open) only gets probe_timeout seconds and no retries.
+   In change-driven mode, a capture whose content fingerprint is the one of the last frame (since) is unchanged and takes no frames.
+   The captured frames are encoded and saved in the encoder pool, so the browser can move on to the next capture.
+   The durations of all phases are sent to the main process with the outcome of the capture.
+   """
+   frames      = None
+   fingerprint = None
+   timer       = CaptureTimer()
+   outcome     = "failed"
+   started     = monotonic()
+   target      = args.targets[key]
+   # retries have to be done before the next tick of the site and before the capture deadline
+   next_tick   = started + (dt_utc + td(minutes=args.interval) - dt.now(tz.utc)).total_seconds()
+   deadline    = started + args.capture_deadline if args.capture_deadline else inf
+   # the log records of this capture task carry its site and tick
+   log_fields.set({"site": key, "tick": dt_utc.strftime("%Y-%m-%dT%H:%M:%SZ")})
+   async with limit:
+      try:
+         for attempt in count():
+            timer.attempts += 1
+            # the first attempt may take until the capture deadline, a retry only until the next tick
+            timeout = args.probe_timeout if probe else (deadline if attempt == 0 else min(next_tick, deadline)) - monotonic()
+            try:
+               captured = await asyncio.wait_for(capture_site(args, dt_utc, logger, browsers, timer, target, since), None if timeout == inf else timeout)
+               if captured is None:
+                  outcome  = "failed"
+               else:
+                  frames, fingerprint  = captured
+                  outcome              = "ok" if frames else "unchanged"
+            except TimeoutError:
+               outcome  = "timeout"
+               log_exception(TimeoutError(f"Capture of {key} at {dt_minutes_mark(dt_utc)} exceeded {timeout:.0f}s (attempt {attempt + 1})"), args, logger)
+               # the browser might hang, so we take it out of service (a probe just ran out of its short timeout)
+               if not probe: await browsers.retire()
+            except Exception as e:
+               outcome  = "error"
+               log_exception(e, args, logger)
+            
+            if outcome in ("ok", "unchanged") or probe or attempt >= args.retries: break
+            # full jitter, so the retries of several sites and processes don't hit the sites at the same time
+            backoff = uniform(0, min(args.backoff_max, args.backoff * 2 ** attempt))
+            # a retry needs at least probe_timeout seconds before the next tick, otherwise we give up on this tick
+            if monotonic() + backoff + args.probe_timeout > min(next_tick, deadline): break
+            with timer.phase("backoff"):
+               await asyncio.sleep(backoff)
+      finally:
+         results.put(("captured", (job_id, outcome, fingerprint)))
+   
+   # add watermark (if desired), encode and save the frames in the encoder pool
+   try:
+      loop  = asyncio.get_running_loop()
+      saved = await asyncio.gather(*(
+         loop.run_in_executor(encoder, save_frame, data, name, dt_utc, position if args.watermark else None, args, store, dedup, timer, animator)
+         for name, data, position in frames or []
+      ))
+      # send the new frames to the main process, which serves the latest frames over the HTTP API and builds their pyramids
+      if args.serve or args.pyramid:
+         for (name, _, _), data in zip(frames or [], saved):
+            if data is not None: results.put(("frame", (name, key, dt_utc, data)))
+   except Exception as e:
+      outcome = "error"
+      log_exception(e, args, logger)
+   finally:
+      record = timer.record(key, args.browser, outcome, dt_utc)
+      logger.info(f"Capture of {key} {outcome}", extra={"phase": "capture", "duration": record["total"], "outcome": outcome, "phases": record["phases"]})
+      results.put(("timing", record))
+      results.put(("done", job_id))
+
+
+async def capture_loop(keys, args, jobs, results, logger):
+   """
+   Receives jobs of the targets (given by their keys) in the event loop of a capture process and takes their screenshots concurrently.
+   """
+   loop     = asyncio.get_running_loop()
+   browsers = BrowserManager(args.browser, args.timeout, args.max_uses, HttpCache(args) if args.cache else None)
+   # limit the number of concurrent captures per target
+   limits   = { key: asyncio.Semaphore(args.site_concurrency) for key in keys }
+   # encode the frames in threads (Pillow releases the GIL while encoding)
+   encoder  = ThreadPoolExecutor(max_workers=args.encode_workers)
+   # save the frames as loose files or in the archive
+   store    = FrameArchive(args) if args.storage == "archive" else FrameFiles(args)
+   # skip saving unchanged frames (if desired)
+   dedup    = FrameDeduplicator(args) if args.dedup != "off" else None
+   # keep rolling animations of the frames (if desired)
+   animator = RollingAnimation(args) if args.animation else None
+   tasks    = set()
+   try:
+      # wait for jobs (id, target key, datetime of the screenshot, probe flag and fingerprint and datetime of the target's last frame)
+      # until we receive None, without blocking the event loop
+      while (job := await loop.run_in_executor(None, jobs.get)) is not None:
+         job_id, key, dt_utc, probe, since = job
+         task = asyncio.create_task(capture(job_id, key, dt_utc, probe, since, args, browsers, limits[key], encoder, store, dedup, animator, results, logger))
+         # keep a reference to the task until it is done
+         tasks.add(task)
+         task.add_done_callback(tasks.discard)
+      # let the remaining captures finish
+      if tasks: await asyncio.gather(*tasks)
+   finally:
+      await browsers.close()
+      encoder.shutdown()
+
+
+async def capture_batch(args, times, logger):
+   """
+   Captures the maps of all targets of sites with a time URL (e.g. metmaps) for many datetimes (e.g. the backfill of a day)
+   in parallel: per site, batch_pages pages of one browser context load the URL templates filled with the datetimes.
+   The frames are watermarked with the valid time of their map and saved like the frames of the ticks,
+   but without deduplication and animation, which need the frames in time order.
+   Returns the number of captured frames (including the extra regions of the targets) and the number of maps.
+   """
+   loop     = asyncio.get_running_loop()
+   browsers = BrowserManager(args.browser, args.timeout, 0, HttpCache(args) if args.cache else None)
+   encoder  = ThreadPoolExecutor(max_workers=args.encode_workers)
+   store    = FrameArchive(args) if args.storage == "archive" else FrameFiles(args)
+   metrics  = MetricsWriter(args) if args.metrics else None
+   pending  = {}
+   for dt_utc in times:
+      for key, target in args.targets.items():
+         if args.site_registry[target["site"]]["time_url"]: pending.setdefault(target["site"], asyncio.Queue()).put_nowait((key, target, dt_utc))
+   jobs     = sum(queue.qsize() for queue in pending.values())
+   saves    = set()
+   captured = 0
+   
+   async def save(frames, key, target, dt_utc, timer):
+      """
+      Watermarks, encodes and saves the frames of a map in the encoder pool and writes its timing record.
+      """
+      nonlocal captured
+      outcome = "failed"
+      try:
+         for name, data, position in frames:
+            await loop.run_in_executor(encoder, save_frame, data, name, dt_utc, position if args.watermark else None, args, store, None, timer)
+            outcome     = "ok"
+            captured   += 1
+      except Exception as e:
+         outcome = "error"
+         log_exception(e, args, logger)
+      if metrics is not None: metrics.record(timer.record(key, args.browser, outcome, dt_utc), {}, {})
+      if args.verbose: print(f"{target['name']} {dt_minutes_mark(dt_utc)}: {outcome}")
+   
+   async def work(site, queue, context):
+      """
+      Captures the pending targets and datetimes of a site one after another in an own page of the context.
+      """
+      page     = await context.new_page()
+      requests = await route_requests(page, args.request_filters[site], browsers.cache, args.metrics)
+      while not queue.empty():
+         key, target, dt_utc = queue.get_nowait()
+         timer    = CaptureTimer()
+         # retry a failed map right away, there is no next tick to wait for
+         for attempt in range(args.retries + 1):
+            timer.attempts += 1
+            if (data := await site_screenshot(page, target, dt_utc, args, logger, timer)) is not None: break
+         # take screenshots of the extra regions of the target from the same loaded map
+         frames   = [] if data is None else [(target["name"], data, target["position"])] + await region_frames(page, target, args, logger, timer)
+         # the page moves on to the next map while the frames are saved
+         task = asyncio.create_task(save(frames, key, target, dt_utc, timer))
+         saves.add(task)
+         task.add_done_callback(saves.discard)
+      log_requests(site, requests, args, logger)
+   
+   try:
+      # one site after another, each in its own browser context (with the credentials, if the site needs a login)
+      for site, queue in pending.items():
+         async with browsers.new_context(**page_options(site, args)) as context:
+            await asyncio.gather(*(work(site, queue, context) for _ in range(min(args.batch_pages, queue.qsize()))))
+      if saves: await asyncio.gather(*saves)
+   finally:
+      await browsers.close()
+      encoder.shutdown()
+   return captured, jobs
+
+
+def capture_worker(keys, args, jobs, results, logger, log_queue=None):
+   """
+   Runs in a long-lived capture process which keeps its browser warm across ticks.
+   """
+   configure_logging(log_queue, args)
+   # use an own process group, so the process can be killed together with playwright and the browsers
+   if hasattr(os, "setpgrp"): os.setpgrp()
+   asyncio.run(capture_loop(keys, args, jobs, results, logger))
+
+
+def child_pids(pid):
+   """
+   Returns the pids of all descendants of a process (found with pgrep, which Linux and macOS have).
+   """
+   try:
+      children = [ int(child) for child in subprocess.run(["pgrep", "-P", str(pid)], capture_output=True, text=True).stdout.split() ]
+   except OSError:
+      return []
+   return children + [ descendant for child in children for descendant in child_pids(child) ]
+
+
+def kill_process_tree(pid):
+   """
+   Kills a capture process together with all its child processes (playwright driver and browsers).
+   """
+   if platform.system() == "Windows":
+      subprocess.run(["taskkill", "/F", "/T", "/PID", str(pid)], capture_output=True)
+   else:
+      # playwright launches the browsers detached (each leads its own process group), so they are found before
+      # the capture process dies (afterwards they belong to init) and killed with their own groups
+      descendants = child_pids(pid)
+      # the capture process is the leader of its own process group (with the playwright driver), which can't launch any more browsers then
+      try:
+         os.killpg(pid, signal.SIGKILL)
+      except ProcessLookupError: pass
+      for descendant in descendants:
+         try:
+            if os.getpgid(descendant) == descendant: os.killpg(descendant, signal.SIGKILL)
+            else: os.kill(descendant, signal.SIGKILL)
+         except ProcessLookupError: pass
+
+
+class CaptureWorker:
+   """
+   Handle for a long-lived capture process of one or more targets (given by their keys).
+   """
+   def __init__(self, keys, args, logger):
+      self.keys      = keys
+      self.args      = args
+      self.logger    = logger
+      self.process   = None
+   
+   def start(self):
+      """
+      Starts the capture process with new job and result queues.
+      """
+      self.jobs      = Queue()
+      self.results   = Queue()
+      self.process   = Process(
+         target   = capture_worker,
+         args     = (self.keys, self.args, self.jobs, self.results, self.logger, log_queue),
+         daemon   = True
+      )
+      self.process.start()
+   
+   def alive(self):
+      """
+      Returns True if the capture process is running.
+      """
+      return self.process is not None and self.process.is_alive()
+   
+   def submit(self, job_id, key, dt_utc, probe=False, since=None):
+      """
+      Sends a job to the capture process, (re)starting the process if it is not alive.
+      """
+      if not self.alive(): self.start()
+      self.jobs.put((job_id, key, dt_utc, probe, since))
+   
+   def poll(self):
+      """
+      Returns all messages the capture process sent since the last call, without waiting.
+      """
+      messages = []
+      if self.process is not None:
+         try:
+            while True: messages.append(self.results.get_nowait())
+         except Empty: pass
+      return messages
+   
+   def kill(self):
+      """
+      Kills the capture process with all its browsers, it is restarted with the next job.
+      """
+      if self.alive():
+         kill_process_tree(self.process.pid)
+         self.process.join()
+   
+   def stop(self):
+      """
+      Lets the capture process finish its remaining jobs and waits for it to exit.
+      """
+      if self.alive():
+         self.jobs.put(None)
+         self.process.join()
+
+
+def create_workers(args, logger):
+   """
+   Creates the long-lived capture processes of the targets, which keep their browser warm across ticks:
+   process -> one capture process per site type (e.g. one for all metmaps targets), async -> one capture process for all targets,
+   pool -> pool_size capture processes (0 = one per CPU core), each of which can capture every target.
+   Deduplication and animations keep the state of a target (manifest offsets, frame window) in its capture process,
+   so with one of them the pool pins every target to one process (round robin) instead.
+   """
+   keys = list(args.targets)
+   match args.engine:
+      case "async":
+         return [ CaptureWorker(keys, args, logger) ]
+      case "pool" if args.dedup != "off" or args.animation:
+         size = min(len(keys), args.pool_size or os.cpu_count() or 1)
+         return [ CaptureWorker(keys[i::size], args, logger) for i in range(size) ]
+      case "pool":
+         return [ CaptureWorker(keys, args, logger) for _ in range(args.pool_size or os.cpu_count() or 1) ]
+      case _:
+         sites = dict.fromkeys(target["site"] for target in args.targets.values())
+         return [ CaptureWorker([ key for key in keys if args.targets[key]["site"] == site ], args, logger) for site in sites ]
+
+
+class CircuitBreaker:
+   """
+   Circuit breaker of a site: after threshold consecutive failed captures it opens, so the ticks of the site
+   are only sent as cheap probes (short timeout, no retries) instead of paying the full timeout every tick.
+   The first successful probe closes it again.
+   """
+   def __init__(self, threshold):
+      self.threshold    = threshold
+      self.failures     = 0
+      self.state        = "closed"
+      # state -> number of times the breaker changed to it
+      self.changes      = { "open": 0, "closed": 0 }
+   
+   def probe(self):
+      """
+      Returns True if the next capture of the site should be a probe.
+      """
+      return self.state == "open"
+   
+   def record(self, ok):
+      """
+      Counts the outcome of a capture and returns the new state if the breaker changed it, else None.
+      """
+      self.failures = 0 if ok else self.failures + 1
+      if ok and self.state == "open":
+         self.state = "closed"
+      elif not ok and self.state == "closed" and self.threshold and self.failures >= self.threshold:
+         self.state = "open"
+      else:
+         return None
+      self.changes[self.state] += 1
+      return self.state
+
+
+class MetricsWriter:
+   """
+   Appends the timing record of every capture to a JSON lines file and keeps a Prometheus text-format file
+   (e.g. for the textfile collector of the node exporter) with histograms of the phase durations
+   per site, browser and outcome and the tick counters of the dispatcher.
+   """
+   # upper bounds of the histogram buckets in seconds
+   buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+   
+   def __init__(self, args):
+      self.metrics_path    = Path(args.metrics_file)
+      self.prometheus_path = Path(args.prometheus_file) if args.prometheus_file else None
+      # (site, browser, phase, outcome) -> bucket counts, count and sum
+      self.histograms      = {}
+   
+   def record(self, record, counts, breakers):
+      """
+      Writes a timing record and updates the Prometheus file with it, the tick counters and the circuit breakers.
+      """
+      with open(self.metrics_path, "a") as f:
+         f.write(json.dumps(record) + "\n")
+      
+      for phase, seconds in dict(record["phases"], total=record["total"]).items():
+         key         = (record["site"], record["browser"], phase, record["outcome"])
+         histogram   = self.histograms.setdefault(key, [0] * len(self.buckets) + [0, 0.0])
+         # the buckets are cumulative
+         for i, bound in enumerate(self.buckets):
+            if seconds <= bound: histogram[i] += 1
+         histogram[-2] += 1
+         histogram[-1] += seconds
+      
+      if self.prometheus_path is not None: self.write_prometheus(counts, breakers)
+   
+   def write_prometheus(self, counts, breakers):
+      """
+      Rewrites the Prometheus text-format file atomically, so the collector never reads a partial file.
+      """
+      lines = [
+         "# HELP screenshotter_phase_seconds Durations of the capture phases (launch, context, goto, ready, screenshot, watermark, save, total).",
+         "# TYPE screenshotter_phase_seconds histogram"
+      ]
+      for (site, browser, phase, outcome), histogram in sorted(self.histograms.items()):
+         labels = f'site="{site}",browser="{browser}",phase="{phase}",outcome="{outcome}"'
+         for bound, n in zip(self.buckets, histogram):
+            lines.append(f'screenshotter_phase_seconds_bucket{{{labels},le="{bound}"}} {n}')
+         lines.append(f'screenshotter_phase_seconds_bucket{{{labels},le="+Inf"}} {histogram[-2]}')
+         lines.append(f'screenshotter_phase_seconds_sum{{{labels}}} {histogram[-1]:.4f}')
+         lines.append(f'screenshotter_phase_seconds_count{{{labels}}} {histogram[-2]}')
+      lines += [
+         "# HELP screenshotter_ticks_total Ticks per site by state (submitted, done, skipped, queued, killed, lost).",
+         "# TYPE screenshotter_ticks_total counter"
+      ]
+      for site, site_counts in counts.items():
+         for state, n in site_counts.items():
+            lines.append(f'screenshotter_ticks_total{{site="{site}",state="{state}"}} {n}')
+      lines += [
+         "# HELP screenshotter_breaker_open Whether the circuit breaker of the site is open (only probes are sent).",
+         "# TYPE screenshotter_breaker_open gauge"
+      ]
+      for site, breaker in breakers.items():
+         lines.append(f'screenshotter_breaker_open{{site="{site}"}} {int(breaker.state == "open")}')
+      lines += [
+         "# HELP screenshotter_breaker_changes_total State changes of the circuit breaker per site and new state.",
+         "# TYPE screenshotter_breaker_changes_total counter"
+      ]
+      for site, breaker in breakers.items():
+         for state, n in breaker.changes.items():
+            lines.append(f'screenshotter_breaker_changes_total{{site="{site}",state="{state}"}} {n}')
+      write_atomic(self.prometheus_path, ("\n".join(lines) + "\n").encode())
+
+
+def percentile(values, p):
+   """
+   Returns the p-th percentile (nearest rank) of the sorted values.
+   """
+   return values[max(0, ceil(p / 100 * len(values)) - 1)]
+
+
+def print_stats(metrics_file):
+   """
+   Prints the number of captures per site and outcome and p50/p95/p99 of the phase durations per site from the metrics file.
+   """
+   outcomes    = {}
+   durations   = {}
+   with open(metrics_file) as f:
+      for line in f:
+         record = json.loads(line)
+         outcomes.setdefault(record["site"], {}).setdefault(record["outcome"], 0)
+         outcomes[record["site"]][record["outcome"]] += 1
+         for phase, seconds in dict(record["phases"], total=record["total"]).items():
+            durations.setdefault((record["site"], phase), []).append(seconds)
+   
+   for site, site_outcomes in sorted(outcomes.items()):
+      print(f"{site}: " + ", ".join(f"{outcome} {n}" for outcome, n in sorted(site_outcomes.items())))
+   print(f"\n{'site':<10}{'phase':<12}{'n':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+   for (site, phase), values in sorted(durations.items()):
+      values.sort()
+      print(f"{site:<10}{phase:<12}{len(values):>8}" + "".join(f"{percentile(values, p):>10.3f}" for p in (50, 95, 99)))
+
+
+class CaptureDispatcher:
+   """
+   Sends capture jobs of the targets to the capture processes and keeps track of the captures in flight.
+   A target can be captured by one or more capture processes (pool engine), each job goes to the process with the least
+   expected remaining work, estimated from the recent capture durations of the targets in flight (load-aware balancing).
+   A target with site_concurrency captures in flight (or a full max_inflight cap) gets its tick skipped or queued,
+   depending on the overlap rule. Only the latest queued tick of a target is kept.
+   Captures exceeding capture_deadline (plus a grace period for the capture process to cancel them)
+   are killed together with their capture process.
+   Each target has a circuit breaker, which turns its ticks into probes after breaker_threshold failed captures in a row.
+   The completion of every tick over all its targets is tracked and logged.
+   The thumbnail pyramids of the new frames are built in a pool of processes (if pyramid levels are given).
+   """
+   # seconds the capture process gets to cancel a capture by itself, before it is killed
+   kill_grace     = 10
+   # seconds between two checks of the capture processes
+   poll_interval  = 0.2
+   # expected duration of a capture in seconds, until the target has been captured once
+   expected_default = 10
+   # weight of the latest capture duration in the expected duration (exponential moving average)
+   expected_weight  = 0.3
+   
+   def __init__(self, workers, args, logger):
+      self.workers      = workers
+      self.args         = args
+      self.logger       = logger
+      # get the capture processes which can capture each target
+      self.target_workers = {}
+      for worker in workers:
+         for key in worker.keys:
+            self.target_workers.setdefault(key, []).append(worker)
+      self.job_ids      = count()
+      # job id -> [target, datetime of the tick, monotonic start time, capture process]
+      self.inflight     = {}
+      # target -> datetime of the queued tick
+      self.queued       = {}
+      # job id -> (target, capture process) of captures whose frames are being encoded
+      self.encoding     = {}
+      # job ids of the running on-demand captures, which always take a frame (also in change-driven mode)
+      self.forced       = set()
+      self.counts       = { key: dict.fromkeys(("submitted", "done", "skipped", "queued", "killed", "lost"), 0) for key in self.target_workers }
+      self.breakers     = { key: CircuitBreaker(args.breaker_threshold) for key in self.target_workers }
+      # target -> expected duration of its captures in seconds
+      self.expected     = {}
+      # datetime of a tick -> targets whose captures are pending, results and monotonic start time
+      self.ticks        = {}
+      # frame name -> latest frame (with its target, datetime, data and ETag) for the HTTP API
+      self.latest       = {}
+      # target -> monotonic time of its last successful capture
+      self.last_ok      = {}
+      # target -> content fingerprint and datetime of its last frame (change-driven mode)
+      self.fingerprints = {}
+      self.started      = monotonic()
+      # write the timing records of the captures (if desired)
+      self.metrics      = MetricsWriter(args) if args.metrics else None
+      # build the thumbnail pyramids of the new frames in a pool of processes (if desired)
+      self.levels       = pyramid_levels(args.pyramid)
+      self.pyramid      = ProcessPoolExecutor(max_workers=args.pyramid_workers or None) if self.levels else None
+      self.condition    = threading.Condition()
+      self.running      = True
+      # check the capture processes in the background, even while the main thread sleeps until the next tick
+      self.thread       = threading.Thread(target=self.run, daemon=True)
+      self.thread.start()
+   
+   def busy(self, key):
+      """
+      Returns True if the target or the global cap doesn't allow another capture in flight.
+      """
+      target_inflight = sum(job[0] == key for job in self.inflight.values())
+      return target_inflight >= self.args.site_concurrency or (self.args.max_inflight and len(self.inflight) >= self.args.max_inflight)
+   
+   def submit(self, key, dt_utc):
+      """
+      Sends a capture job for the target and tick, or skips/queues it if the target is busy.
+      """
+      with self.condition:
+         # track the completion of the tick over all its targets
+         tick = self.ticks.setdefault(dt_utc, { "pending": set(), "results": {}, "started": monotonic() })
+         tick["pending"].add(key)
+         if not self.busy(key):
+            self.send(key, dt_utc)
+            return
+         # skip the tick or replace an already queued (older) tick of the target
+         if self.args.overlap == "skip" or key in self.queued:
+            self.counts[key]["skipped"] += 1
+            skipped = dt_utc if self.args.overlap == "skip" else self.queued[key]
+            self.note(f"Skipped tick {dt_minutes_mark(skipped)} of {key}, previous capture still in flight")
+            self.resolve(key, skipped, "skipped")
+         if self.args.overlap == "queue":
+            self.queued[key] = dt_utc
+            self.counts[key]["queued"] += 1
+   
+   def load(self, worker, now):
+      """
+      Returns the expected remaining seconds of the captures in flight of a capture process.
+      """
+      return sum(
+         max(0.0, self.expected.get(key, self.expected_default) - (now - started))
+         for key, dt_utc, started, job_worker in self.inflight.values() if job_worker is worker
+      )
+   
+   def send(self, key, dt_utc, force=False):
+      """
+      Sends a capture job to the least loaded capture process of the target.
+      In change-driven mode the job gets the fingerprint of the target's last frame, unless a new frame is forced.
+      """
+      job_id   = next(self.job_ids)
+      now      = monotonic()
+      workers  = self.target_workers[key]
+      worker   = workers[0] if len(workers) == 1 else min(workers, key=lambda worker: self.load(worker, now))
+      since    = self.fingerprints.get(key) if self.args.change_driven and not force else None
+      worker.submit(job_id, key, dt_utc, self.breakers[key].probe(), since)
+      self.inflight[job_id] = [key, dt_utc, now, worker]
+      self.counts[key]["submitted"] += 1
+      return job_id
+   
+   def resolve(self, key, dt_utc, result):
+      """
+      Counts the result of a target in its tick and logs the tick as soon as all its targets are resolved.
+      """
+      tick = self.ticks.get(dt_utc)
+      if tick is None or key not in tick["pending"]: return
+      tick["pending"].discard(key)
+      tick["results"][result] = tick["results"].get(result, 0) + 1
+      if not tick["pending"]:
+         del self.ticks[dt_utc]
+         results = ", ".join(f"{result} {n}" for result, n in sorted(tick["results"].items()))
+         self.note(f"Tick {dt_minutes_mark(dt_utc)} complete after {monotonic() - tick['started']:.1f}s: {results}")
+   
+   def request(self, key):
+      """
+      Takes an on-demand capture of the target now, unless a capture of the target is already running or queued,
+      which the request then shares. Returns the job id (None for a queued tick) and whether the request was coalesced,
+      or None if the caps of the target and of all captures in flight (as for the ticks) don't allow another capture.
+      In change-driven mode a tick's capture may end unchanged without a frame, so only on-demand captures are shared.
+      """
+      with self.condition:
+         self.forced &= self.inflight.keys() | self.encoding.keys()
+         for job_id, job in (self.inflight | self.encoding).items():
+            if job[0] == key and (not self.args.change_driven or job_id in self.forced): return job_id, True
+         if key in self.queued and not self.args.change_driven: return None, True
+         if self.busy(key): return None
+         job_id = self.send(key, dt.now(tz.utc).replace(microsecond=0), force=True)
+         self.forced.add(job_id)
+         return job_id, False
+   
+   def wait_job(self, job_id, timeout):
+      """
+      Waits at most timeout seconds for a capture and its encoding to finish, returns True if it did.
+      """
+      deadline = monotonic() + timeout
+      with self.condition:
+         while job_id in self.inflight or job_id in self.encoding:
+            if (remaining := deadline - monotonic()) <= 0: return False
+            self.condition.wait(min(remaining, 1))
+      return True
+   
+   def status(self):
+      """
+      Returns the state of the captures, ticks, circuit breakers, capture processes and latest frames.
+      """
+      with self.condition:
+         now = monotonic()
+         return {
+            "uptime":   round(now - self.started),
+            "counts":   self.counts,
+            "breakers": { key: breaker.state for key, breaker in self.breakers.items() },
+            "inflight": [ { "target": key, "time": dt_minutes_mark(dt_utc), "running": round(now - started, 1) } for key, dt_utc, started, _ in self.inflight.values() ],
+            "queued":   { key: dt_minutes_mark(dt_utc) for key, dt_utc in self.queued.items() },
+            "ticks":    { dt_minutes_mark(dt_utc): { "pending": sorted(tick["pending"]), "results": tick["results"] } for dt_utc, tick in self.ticks.items() },
+            "workers":  [ { "targets": len(worker.keys), "alive": worker.alive(), "load": round(self.load(worker, now), 1) } for worker in self.workers ],
+            "last_ok":  { key: round(now - self.last_ok[key]) if key in self.last_ok else None for key in self.target_workers },
+            "frames":   { name: { "target": frame["target"], "time": dt_minutes_mark(frame["time"]), "etag": frame["etag"], "bytes": len(frame["data"]) } for name, frame in self.latest.items() }
+         }
+   
+   def healthy(self):
+      """
+      Returns True if the background thread runs and every target had a successful capture within the last 3 intervals
+      (or since the start).
+      """
+      limit = 3 * self.args.interval * 60 + (self.args.capture_deadline or 0)
+      with self.condition:
+         now = monotonic()
+         return self.thread.is_alive() and all(now - self.last_ok.get(key, self.started) <= limit for key in self.target_workers)
+   
+   def note(self, message):
+      """
+      Prints (if verbose) and logs a message of the dispatcher.
+      """
+      if self.args.verbose: print(message)
+      self.logger.info(f"{message}")
+   
+   def breaker(self, key, ok):
+      """
+      Counts the outcome of a capture in the circuit breaker of the target and reports its state changes.
+      """
+      state = self.breakers[key].record(ok)
+      if state is None: return
+      if state == "open":
+         self.note(f"Circuit breaker of {key} opened after {self.breakers[key].failures} failed captures, only probing from now on")
+      else:
+         self.note(f"Circuit breaker of {key} closed, the target is back")
+      if self.metrics is not None and self.metrics.prometheus_path is not None:
+         self.metrics.write_prometheus(self.counts, self.breakers)
+   
+   def drop(self, worker, reason):
+      """
+      Forgets all captures in flight of a killed or crashed capture process.
+      """
+      for job_id, (key, dt_utc, started, job_worker) in list(self.inflight.items()):
+         if job_worker is worker:
+            del self.inflight[job_id]
+            self.counts[key][reason] += 1
+            self.note(f"Capture of {key} at {dt_minutes_mark(dt_utc)} {reason} after {monotonic() - started:.1f}s")
+            self.breaker(key, False)
+            self.resolve(key, dt_utc, reason)
+      for job_id, (key, job_worker) in list(self.encoding.items()):
+         if job_worker is worker:
+            del self.encoding[job_id]
+            self.counts[key][reason] += 1
+   
+   def check(self):
+      """
+      Collects finished captures, enforces the deadlines and sends queued ticks.
+      """
+      for worker in self.workers:
+         for kind, payload in worker.poll():
+            # the browser is done, the frames of the capture are being encoded now
+            if kind == "captured" and payload[0] in self.inflight:
+               job_id, outcome, fingerprint = payload
+               key, dt_utc, started, worker = self.inflight.pop(job_id)
+               self.encoding[job_id] = (key, worker)
+               self.breaker(key, outcome in ("ok", "unchanged"))
+               self.resolve(key, dt_utc, outcome)
+               # update the expected duration of the target's captures
+               duration             = monotonic() - started
+               self.expected[key]   = duration if key not in self.expected else (1 - self.expected_weight) * self.expected[key] + self.expected_weight * duration
+               if outcome in ("ok", "unchanged"): self.last_ok[key] = monotonic()
+               # remember the content of the target's new frame
+               if outcome == "ok" and fingerprint is not None: self.fingerprints[key] = (fingerprint, dt_utc)
+            elif kind == "frame":
+               name, key, dt_utc, data = payload
+               self.latest[name] = { "target": key, "time": dt_utc, "data": data, "etag": f'"{hashlib.sha256(data).hexdigest()[:32]}"' }
+               if self.pyramid is not None and image_extension(data) != "svgz":
+                  self.pyramid.submit(build_pyramid, data, name, dt_utc, self.levels, self.args).add_done_callback(self.pyramid_done)
+            elif kind == "done" and payload in self.encoding:
+               key = self.encoding.pop(payload)[0]
+               self.counts[key]["done"] += 1
+               if self.metrics is not None and self.metrics.prometheus_path is not None:
+                  self.metrics.write_prometheus(self.counts, self.breakers)
+            elif kind == "timing" and self.metrics is not None:
+               self.metrics.record(payload, self.counts, self.breakers)
+         # the capture process might have crashed
+         if not worker.alive(): self.drop(worker, "lost")
+      
+      # kill the capture processes of captures which exceeded the hard deadline
+      if self.args.capture_deadline:
+         hard_deadline = self.args.capture_deadline + self.kill_grace
+         for key, dt_utc, started, worker in list(self.inflight.values()):
+            if monotonic() - started > hard_deadline and worker.alive():
+               worker.kill()
+               self.drop(worker, "killed")
       
-      # open the chosen browser
-      match args.browser:
-         case "chromium":
-            browser  = p.chromium.launch()
-         case "chrome":
-            browser  = p.chromium.launch(channel="chrome")
-         case "firefox":
-            browser = p.firefox.launch()
-         case "edge":
-            browser = p.chromium.launch(channel="msedge")
-         case "webkit":
-            browser = p.webkit.launch()
+      # send queued ticks of targets which are not busy anymore
+      for key, dt_utc in list(self.queued.items()):
+         if not self.busy(key):
+            del self.queued[key]
+            self.send(key, dt_utc)
+   
+   def pyramid_done(self, future):
+      """
+      Logs a failed pyramid of a frame.
+      """
+      if (e := future.exception()) is not None: log_exception(e, self.args, self.logger)
+   
+   def run(self):
+      """
+      Checks the capture processes periodically in a background thread.
+      """
+      while self.running:
+         with self.condition:
+            try:
+               self.check()
+            except Exception as e:
+               log_exception(e, self.args, self.logger)
+            self.condition.notify_all()
+         sleep(self.poll_interval)
+   
+   def wait(self):
+      """
+      Waits until all captures in flight, their encoding and queued ticks are done.
+      """
+      with self.condition:
+         while self.inflight or self.encoding or self.queued:
+            self.condition.wait(1)
+   
+   def stop(self):
+      """
+      Waits for the remaining captures, then stops the capture processes and the background thread.
+      """
+      self.wait()
+      self.running = False
+      self.thread.join()
+      for worker in self.workers:
+         worker.stop()
+      # let the pyramids of the last frames finish
+      if self.pyramid is not None: self.pyramid.shutdown(wait=True)
+      # print (if verbose) and log how many ticks were skipped, queued or killed per target
+      for key, counts in self.counts.items():
+         self.note(f"Captures of {key}: " + ", ".join(f"{k} {v}" for k, v in counts.items()))
+   
+
+class ControlHandler(BaseHTTPRequestHandler):
+   """
+   Local HTTP API of the daemon mode:
+   GET /frames -> latest frame of each frame name (datetime, ETag, size) as JSON,
+   GET /frames/{name} -> latest frame from memory (304 if it matches If-None-Match),
+   POST /capture/{target}?wait=SECONDS -> on-demand capture, coalesced with a running capture of the target,
+   GET /status -> scheduler, captures, circuit breakers and capture processes as JSON,
+   GET /health -> 200 if healthy, else 503.
+   """
+   def do_GET(self):
+      dispatcher  = self.server.dispatcher
+      path        = urlsplit(self.path).path.rstrip("/")
+      match path.split("/")[1:]:
+         case ["frames"]:
+            self.reply_json(dispatcher.status()["frames"])
+         case ["frames", name]:
+            with dispatcher.condition:
+               frame = dispatcher.latest.get(name)
+            if frame is None:
+               self.reply_json({ "error": f"no frame {name} yet" }, 404)
+            elif self.headers.get("If-None-Match") == frame["etag"]:
+               self.send_response(304)
+               self.send_header("ETag", frame["etag"])
+               self.end_headers()
+            else:
+               self.send_response(200)
+               if image_extension(frame["data"]) == "svgz":
+                  self.send_header("Content-Type", "image/svg+xml")
+                  self.send_header("Content-Encoding", "gzip")
+               else:
+                  self.send_header("Content-Type", f"image/{image_extension(frame['data']).replace('jpg', 'jpeg')}")
+               self.send_header("Content-Length", str(len(frame["data"])))
+               self.send_header("ETag", frame["etag"])
+               self.send_header("Cache-Control", "no-cache")
+               self.send_header("X-Frame-Time", frame["time"].strftime("%Y-%m-%dT%H:%M:%SZ"))
+               self.end_headers()
+               self.wfile.write(frame["data"])
+         case ["status"]:
+            status = dispatcher.status()
+            if (scheduler := self.server.scheduler) is not None:
+               status["scheduler"] = {
+                  "interval": scheduler.interval,
+                  "policy":   scheduler.policy,
+                  "ticks":    scheduler.ticks,
+                  "missed":   scheduler.missed,
+                  "late_mean": round(scheduler.late_sum / scheduler.ticks, 3) if scheduler.ticks else None,
+                  "late_max": round(scheduler.late_max, 3),
+                  "next_tick": dt_minutes_mark(scheduler.start_datetime + td(seconds=(scheduler.tick + 1) * scheduler.interval))
+               }
+            self.reply_json(status)
+         case ["health"]:
+            healthy = dispatcher.healthy()
+            self.reply_json({ "healthy": healthy }, 200 if healthy else 503)
+         case _:
+            self.reply_json({ "error": "not found" }, 404)
+   
+   def do_POST(self):
+      dispatcher  = self.server.dispatcher
+      url         = urlsplit(self.path)
+      match url.path.rstrip("/").split("/")[1:]:
+         case ["capture", key] if key in dispatcher.target_workers:
+            try:
+               wait           = float(parse_qs(url.query).get("wait", ["0"])[0])
+            except ValueError:
+               return self.reply_json({ "error": "wait has to be a number of seconds" }, 400)
+            if (requested := dispatcher.request(key)) is None:
+               return self.reply_json({ "error": "too many captures in flight, try again later" }, 503)
+            job_id, coalesced = requested
+            done              = dispatcher.wait_job(job_id, wait) if job_id is not None and wait > 0 else False
+            self.reply_json({ "job": job_id, "coalesced": coalesced, "done": done }, 200 if done else 202)
+         case ["capture", key]:
+            self.reply_json({ "error": f"target {key} is not captured" }, 404)
          case _:
-            err = f"Browser {args.browser} not supported. Please choose from {browsers_available}."
-            if verbose: print(err)
-            logger.error(err)
+            self.reply_json({ "error": "not found" }, 404)
+   
+   def reply_json(self, data, status=200):
+      """
+      Sends the data as JSON with the given status.
+      """
+      body = json.dumps(data).encode()
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+   
+   def log_message(self, format, *args):
+      # log the requests instead of printing them
+      self.server.logger.info(f"API {self.address_string()} {format % args}")
+
+
+class ControlServer(ThreadingHTTPServer):
+   """
+   Serves the local HTTP API of the daemon mode in a background thread.
+   """
+   daemon_threads = True
+   
+   def __init__(self, dispatcher, args, logger):
+      super().__init__((args.serve_host, args.serve), ControlHandler)
+      self.dispatcher   = dispatcher
+      self.logger       = logger
+      # the scheduler is set as soon as the ticks begin
+      self.scheduler    = None
+      threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+@lru_cache
+def watermark_font(font_size):
+   """
+   Loads the default font in the given size, only once per size and process.
+   """
+   from PIL import ImageFont
+   
+   #font = ImageFont.truetype("arial.ttf", int(font_size/12))
+   return ImageFont.load_default(size=font_size)
+
+
+def add_watermark(image, position, dt_utc):
+   """ 
+   Adds a datetime watermark to the (already decoded) image, in place.
+   """
+   from PIL import ImageDraw
+   
+   draw = ImageDraw.Draw(image)
+   
+   # get the size of the image 
+   w, h = image.size
+   # set the position of the watermark  
+   if position == "bl":
+      # bottom left
+      x, y = int(w / 4), int(h - h / 50)
+      # set the font size, depending on the height of the image
+      font_size = int(h/18)
+   elif position == "br":
+      # bottom right 
+      x, y = int(w - w / 5), int(h - h / 50)
+      # set the font size, depending on the width of the image
+      font_size = int(w/20)
+   
+   # add watermark
+   draw.text((x, y), dt_minutes_mark(dt_utc), fill="red", font=watermark_font(font_size), anchor='ms')
+
+
+def write_atomic(path, data):
+   """
+   Writes the data to a temporary file first and renames it afterwards, so nobody ever sees a partial file.
+   The temporary file is unique per process and thread, so concurrent writers of the same file (e.g. the capture processes
+   caching the same URL) don't replace each other's temporary file, the last rename wins.
+   """
+   tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+   tmp_path.write_bytes(data)
+   os.replace(tmp_path, path)
+
+
+# file extensions of the output formats
+extensions = { "png": "png", "webp": "webp", "jpeg": "jpg" }
+
+
+def frame_path(args, name, dt_utc, extension=None):
+   """
+   Returns the path of a frame in the output directory, with the given extension or the one of the output format.
+   """
+   return Path(f"{args.output_dir}/{name}_{dt_minutes_file(dt_utc)}.{extension or extensions[args.format]}")
+
+
+def encode_image(image, args):
+   """
+   Encodes the image in the chosen output format with its options and returns the bytes.
+   """
+   buffer = BytesIO()
+   match args.format:
+      case "png":
+         # -1 (keep the browser's PNG) falls back to Pillow's default level if the image has to be encoded anyway
+         image.save(buffer, format="PNG", compress_level=args.compress_level if args.compress_level >= 0 else 6)
+      case "webp":
+         # with lossless WebP the quality is the compression effort
+         image.save(buffer, format="WEBP", lossless=bool(args.lossless), quality=args.quality)
+      case "jpeg":
+         # JPEG has no alpha channel
+         image.convert("RGB").save(buffer, format="JPEG", quality=args.quality, optimize=True)
+   return buffer.getvalue()
+
+
+def save_frame(data, name, dt_utc, position, args, store, dedup=None, timer=None, animator=None):
+   """
+   Post-processes the captured PNG bytes of a frame in memory and saves them in the frame store.
+   The image is decoded once, checked for changes (if dedup is given), watermarked (if position is given)
+   and encoded once in the output format. PNG frames without watermark are saved as captured if compress_level is -1.
+   The frame is also added to its rolling animation, if an animator is given and the frame is not decimated.
+   The watermark, the animation and everything else (decoding, hashing, encoding and writing) are timed with the (optional) capture timer.
+   Returns the saved (encoded) frame, or None if it was unchanged.
+   """
+   frame_timer = CaptureTimer()
+   started     = perf_counter()
+   image       = None
+   changed     = True
+   saved       = None
+   
+   # vector frames (compressed SVG documents, already watermarked) are saved as they are and rasterized offline
+   if image_extension(data) == "svgz":
+      store.write(name, dt_utc, data)
+      if timer is not None: timer.add("save", perf_counter() - started)
+      return data
+   
+   if dedup is not None or animator is not None or position is not None or args.format != "png" or args.compress_level >= 0:
+      from PIL import Image
+      
+      image = Image.open(BytesIO(data))
+      image.load()
+   
+   # without deduplication, just save the frame
+   if dedup is None:
+      saved    = render_frame(image, data, position, dt_utc, args, frame_timer)
+      store.write(name, dt_utc, saved)
+   # else hash the clipped screenshot before the watermark is added and skip the frame if it didn't change
+   else:
+      frame_hash = dedup.hash(image)
+      with dedup.lock(name):
+         if changed := not dedup.unchanged(name, frame_hash, dt_utc, store):
+            saved    = render_frame(image, data, position, dt_utc, args, frame_timer)
+            location = store.write(name, dt_utc, saved)
+            dedup.record(name, frame_hash, dt_utc, location)
+   
+   # add the frame to the rolling animation, an unchanged frame only gets its watermark for the animation
+   if animator is not None and animator.wants(name, dt_utc):
+      if not changed and position is not None:
+         with frame_timer.phase("watermark"):
+            add_watermark(image, position, dt_utc)
+      with frame_timer.phase("animation"):
+         animator.add(name, dt_utc, image)
+   
+   if timer is not None:
+      watermark = frame_timer.phases.get("watermark", 0.0)
+      animation = frame_timer.phases.get("animation", 0.0)
+      timer.add("watermark", watermark)
+      if animator is not None: timer.add("animation", animation)
+      timer.add("save", perf_counter() - started - watermark - animation)
+   return saved
+
+
+def render_frame(image, data, position, dt_utc, args, timer):
+   """
+   Watermarks and encodes the decoded image, if any, else returns the data as it is.
+   """
+   if image is not None:
+      if position is not None:
+         with timer.phase("watermark"):
+            add_watermark(image, position, dt_utc)
+      data = encode_image(image, args)
+   return data
+
+
+def image_extension(data):
+   """
+   Returns the file extension of encoded image data, by its magic bytes.
+   """
+   if data.startswith(b"\x89PNG"):
+      return "png"
+   if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+      return "webp"
+   if data.startswith(b"\xff\xd8"):
+      return "jpg"
+   # vector frames are gzip-compressed SVG documents
+   if data.startswith(b"\x1f\x8b"):
+      return "svgz"
+   return "bin"
+
+
+@contextmanager
+def file_lock(f):
+   """
+   Locks an open file exclusively (also against other processes) while the block runs.
+   """
+   if platform.system() == "Windows":
+      import msvcrt
+      f.seek(0)
+      msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+      try:
+         yield
+      finally:
+         f.seek(0)
+         msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+   else:
+      import fcntl
+      fcntl.flock(f, fcntl.LOCK_EX)
+      try:
+         yield
+      finally:
+         fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class FrameFiles:
+   """
+   Saves every frame as a loose file in the output directory, named by frame name and datetime.
+   The frames are added to the retention index, if a retention policy is given.
+   """
+   def __init__(self, args):
+      self.args  = args
+      self.index = RetentionIndex(args) if args.retention else None
+   
+   def write(self, name, dt_utc, data):
+      """
+      Writes the frame atomically and returns its file name.
+      """
+      image_path = frame_path(self.args, name, dt_utc, image_extension(data))
+      write_atomic(image_path, data)
+      if self.index is not None: self.index.add(name, dt_utc, image_path.name)
+      return image_path.name
+   
+   def link(self, name, dt_utc, frame):
+      """
+      Hard links the unchanged frame to the given manifest entry, if possible.
+      """
+      try:
+         os.link(Path(self.args.output_dir, frame["file"]), image_path := frame_path(self.args, name, dt_utc))
+      except OSError: return
+      if self.index is not None: self.index.add(name, dt_utc, image_path.name)
+   
+   def exists(self, name, dt_utc):
+      """
+      Returns True if the frame file exists.
+      """
+      return frame_path(self.args, name, dt_utc).exists()
+   
+   def frames(self, name, start, end):
+      """
+      Yields (datetime, encoded frame) of all frame files of the name between start and end (included), in time order.
+      """
+      found = []
+      for path in Path(self.args.output_dir).glob(f"{name}_*.*"):
+         try:
+            dt_utc = dt.strptime(path.name[len(name) + 1:].split(".", 1)[0], "%Y-%m-%d_%H%M").replace(tzinfo=tz.utc)
+         # the file belongs to another frame name (e.g. dwd_vector for dwd)
+         except ValueError: continue
+         if start <= dt_utc <= end: found.append((dt_utc, path))
+      for dt_utc, path in sorted(found):
+         yield dt_utc, path.read_bytes()
+
+
+class FrameArchive:
+   """
+   Appends frames to one container file per frame name and day ({name}_{YYYY-mm-dd}.frames) instead of loose files.
+   Each record is a header (magic, timestamp, length) followed by the encoded image, so the container can be scanned.
+   An index file ({name}_{YYYY-mm-dd}.idx) holds one fixed-size entry (timestamp, offset, length) per frame in time order,
+   so a frame is read with a single seek into the container and time ranges are streamed in order.
+   The frames are added to the retention index, if a retention policy is given.
+   """
+   magic    = b"FRM1"
+   header   = struct.Struct("<4sqI")
+   entry    = struct.Struct("<qQI")
+   
+   def __init__(self, args):
+      self.args  = args
+      self.index = RetentionIndex(args) if args.retention else None
+   
+   def paths(self, name, day):
+      """
+      Returns the container and index paths of a frame name and day.
+      """
+      base = Path(self.args.output_dir, f"{name}_{day:%Y-%m-%d}")
+      return base.with_suffix(".frames"), base.with_suffix(".idx")
+   
+   def append(self, name, dt_utc, data=None, offset=None, length=None):
+      """
+      Appends a frame (or with data=None another index entry to an existing record of the same day) to the archive.
+      """
+      container_path, index_path = self.paths(name, dt_utc)
+      timestamp = int(dt_utc.timestamp())
+      # the index is locked, so several capture processes may append to the same archive
+      with open(index_path, "a+b") as index, file_lock(index):
+         if data is not None:
+            with open(container_path, "ab") as container:
+               offset = container.seek(0, os.SEEK_END) + self.header.size
+               length = len(data)
+               container.write(self.header.pack(self.magic, timestamp, length) + data)
+         # the index entry is written after the record, so it never points to incomplete data
+         self.insert(index, self.entry.pack(timestamp, offset, length), timestamp)
+      if self.index is not None: self.index.add(name, dt_utc, container_path.name)
+      return container_path.name
+   
+   def insert(self, index, entry, timestamp):
+      """
+      Writes an entry into the locked index at its place in time order, so the lookups by bisection stay correct
+      if frames arrive out of order (e.g. from the parallel pages of a batch or a process pool).
+      """
+      size  = index.seek(0, os.SEEK_END)
+      # ignore an incomplete last entry
+      size -= size % self.entry.size
+      if size:
+         index.seek(size - self.entry.size)
+         last = self.entry.unpack(index.read(self.entry.size))[0]
+      # in order (the usual case): just append the entry
+      if not size or last <= timestamp:
+         index.truncate(size)
+         index.write(entry)
+         return
+      index.seek(0)
+      data     = index.read(size)
+      position = bisect_right(list(self.entry.iter_unpack(data)), timestamp, key=lambda e: e[0]) * self.entry.size
+      # the index is opened for appending, so the tail is cut off and written again after the new entry
+      index.truncate(position)
+      index.write(entry + data[position:])
+   
+   def write(self, name, dt_utc, data):
+      """
+      Appends the frame to the container of its day and returns the container file name.
+      """
+      return self.append(name, dt_utc, data)
+   
+   def link(self, name, dt_utc, frame):
+      """
+      Adds an index entry of the unchanged frame pointing to the record of the given manifest entry's last occurrence.
+      Records of earlier days are copied (once per day), so each day stays self-contained.
+      """
+      last = dt.strptime(frame["last"], "%Y-%m-%d %H:%M").replace(tzinfo=tz.utc)
+      if (found := self.find(name, last)) is None: return
+      offset, length = found
+      if last.date() == dt_utc.date():
+         self.append(name, dt_utc, offset=offset, length=length)
+      else:
+         self.append(name, dt_utc, self.read_record(name, last, offset, length))
+   
+   def remove(self, name, day, timestamps):
+      """
+      Rewrites the container and index of a day without the frames of the given timestamps (retention compaction).
+      Records shared by several index entries (unchanged frames) are copied only once. A day without frames is deleted.
+      """
+      container_path, index_path = self.paths(name, day)
+      if not index_path.exists(): return
+      with open(index_path, "ab") as index, file_lock(index):
+         entries = [ entry for entry in self.entries(name, day) if entry[0] not in timestamps ]
+         if not entries:
+            container_path.unlink(missing_ok=True)
+            index_path.unlink(missing_ok=True)
             return
+         # copy the remaining records into a new container, one after another
+         moved       = {}
+         new_entries = []
+         tmp_path    = container_path.with_name(f".{container_path.name}.tmp")
+         with open(container_path, "rb") as container, open(tmp_path, "wb") as new_container:
+            for timestamp, offset, length in entries:
+               if offset not in moved:
+                  container.seek(offset)
+                  moved[offset] = new_container.tell() + self.header.size
+                  new_container.write(self.header.pack(self.magic, timestamp, length) + container.read(length))
+               new_entries.append(self.entry.pack(timestamp, moved[offset], length))
+         os.replace(tmp_path, container_path)
+         write_atomic(index_path, b"".join(new_entries))
+   
+   def entries(self, name, day):
+      """
+      Returns all index entries (timestamp, offset, length) of a frame name and day.
+      """
+      index_path = self.paths(name, day)[1]
+      if not index_path.exists(): return []
+      data = index_path.read_bytes()
+      # ignore an incomplete last entry
+      return list(self.entry.iter_unpack(data[:len(data) - len(data) % self.entry.size]))
+   
+   def find(self, name, dt_utc):
+      """
+      Returns offset and length of the frame at the given datetime, or None if it is not archived.
+      """
+      entries     = self.entries(name, dt_utc)
+      timestamp   = int(dt_utc.timestamp())
+      i           = bisect_left(entries, timestamp, key=lambda entry: entry[0])
+      if i < len(entries) and entries[i][0] == timestamp:
+         return entries[i][1:]
+   
+   def read_record(self, name, day, offset, length):
+      """
+      Reads a record with a single seek into the container of the day.
+      """
+      with open(self.paths(name, day)[0], "rb") as container:
+         container.seek(offset)
+         return container.read(length)
+   
+   def exists(self, name, dt_utc):
+      """
+      Returns True if the frame is archived.
+      """
+      return self.find(name, dt_utc) is not None
+   
+   def read(self, name, dt_utc):
+      """
+      Returns the encoded frame at the given datetime, or None if it is not archived.
+      """
+      if (found := self.find(name, dt_utc)) is not None:
+         return self.read_record(name, dt_utc, *found)
+   
+   def frames(self, name, start, end):
+      """
+      Yields (datetime, encoded frame) of all archived frames between start and end (included), in time order.
+      """
+      day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+      while day <= end:
+         entries = [ e for e in self.entries(name, day) if start.timestamp() <= e[0] <= end.timestamp() ]
+         if entries:
+            with open(self.paths(name, day)[0], "rb") as container:
+               for timestamp, offset, length in entries:
+                  container.seek(offset)
+                  yield dt.fromtimestamp(timestamp, tz.utc), container.read(length)
+         day += td(days=1)
 
-      # create a new browser context with the given user agent and credentials
-      context  = browser.new_context(user_agent=args.user_agent)
-      page     = context.new_page()
-      # set the default timeout for the context and page
-      context.set_default_timeout(args.timeout)
-      page.set_default_timeout(args.timeout)
-      # set the viewport size, only needed when using iframe method
-      #page.set_viewport_size({"width": 556, "height": 600})
-      try:
-         page.goto(URL)
-         page.wait_for_load_state("load")
-      except Exception as e:
-         if args.verbose:
-            print(e)
-            traceback.print_exc()
-         if args.log:
-            dtime = utcnow_seconds_str()
-            err   = f"{e.__class__.__name__}: {e}"
-            trace = traceback.format_exc()
-            logger.error(f"{dtime}\n{err}\n{trace}{'-'*114}")
-         browser.close(reason=str(e))
-         return
-      
-      # click on cookie banner "ACCEPT", not necessary if we only use the iframe of weatherpro.com
+
+def export_frames(args, names, start, end):
+   """
+   Exports archived frames between start and end as loose files into the export directory.
+   """
+   archive     = FrameArchive(args)
+   export_dir  = Path(args.export_dir)
+   export_dir.mkdir(parents=True, exist_ok=True)
+   exported    = 0
+   for name in names:
+      for dt_utc, data in archive.frames(name, start, end):
+         write_atomic(export_dir / f"{name}_{dt_minutes_file(dt_utc)}.{image_extension(data)}", data)
+         exported += 1
+   return exported
+
+
+def rasterize_frame(data, name, dt_utc, widths, args):
+   """
+   Rasterizes a vector frame in all widths (in a process of the rasterizer pool, without a browser)
+   and writes the images in the output format into the export directory. Returns the number of images.
+   """
+   import cairosvg
+   from PIL import Image
+   
+   svg = gzip.decompress(data)
+   for width in widths:
+      image = Image.open(BytesIO(cairosvg.svg2png(bytestring=svg, output_width=width)))
+      image.load()
+      write_atomic(Path(args.export_dir, f"{name}_{width}_{dt_minutes_file(dt_utc)}.{extensions[args.format]}"), encode_image(image, args))
+   return len(widths)
+
+
+def rasterize_frames(args, names, widths, start, end):
+   """
+   Rasterizes the vector frames of the names between start and end in all widths with a pool of raster_workers processes.
+   Returns the number of images.
+   """
+   store       = FrameArchive(args) if args.storage == "archive" else FrameFiles(args)
+   export_dir  = Path(args.export_dir)
+   export_dir.mkdir(parents=True, exist_ok=True)
+   with ProcessPoolExecutor(max_workers=args.raster_workers or None) as pool:
+      futures = [
+         pool.submit(rasterize_frame, data, name, dt_utc, widths, args)
+         for name in names for dt_utc, data in store.frames(name, start, end) if image_extension(data) == "svgz"
+      ]
+      return sum(future.result() for future in futures)
+
+
+# seconds of the age units of the retention tiers
+age_units = { "m": 60, "h": 3600, "d": 86400 }
+
+
+def retention_tiers(spec):
+   """
+   Parses the tiers of the retention policy, e.g. 24h:1,30d:15,*:60 -> frames younger than 24 hours are all kept (every minute),
+   younger than 30 days every 15 minutes and older ones every 60 minutes. Without a last tier * older frames are deleted.
+   Returns the tiers as (maximum age in seconds, step in minutes), ordered by age.
+   """
+   tiers = []
+   for tier in spec.split(","):
+      if not tier.strip(): continue
+      age, _, step = tier.strip().partition(":")
+      if not step.isdigit() or int(step) <= 0 or not (age == "*" or (age[:-1].isdigit() and age[-1:] in age_units)):
+         raise ValueError(f"Retention tier {tier.strip()} has to be AGE:STEP (AGE as e.g. 90m, 24h or 30d, or *)")
+      tiers.append((inf if age == "*" else int(age[:-1]) * age_units[age[-1]], int(step)))
+   tiers.sort()
+   if inf in [ age for age, _ in tiers[:-1] ]: raise ValueError("Only one retention tier may be *")
+   return tiers
+
+
+class RetentionIndex:
+   """
+   Index of the saved frames for the retention policy: frame name, timestamp, file (or archive container) and the step
+   in minutes the frame has been kept at so far. It is a SQLite database in the output directory, shared by all processes,
+   and the frames are added as they are saved, so the compactor never has to scan the output directory.
+   """
+   def __init__(self, args):
+      self.args   = args
+      self.lock   = threading.Lock()
+      self.db     = None
+   
+   def connect(self):
       """
-      try:
-         page.get_by_role('button', name="ZUSTIMMEN").click()
-      except: pass
+      Opens the database on first use (the encoder threads of a capture process share the connection).
       """
-      
-      # wait for map to be fully loaded
-      try:
-         locator = page.locator('#mapContainer').locator('.leaflet-map-pane').locator('.leaflet-overlay-pane').locator('.leaflet-zoom-animated').locator('g')
-         locator.wait_for()
-         # if network_idle is True, wait for the network to be idle
-         if args.network_idle:
-            page.wait_for_load_state('networkidle')
-         # else just wait for the correct load state
-         else: page.wait_for_load_state('load')
-      # if an error occurs, handle it
-      except Exception as e:
-         if args.verbose:
-            print(e)
-            traceback.print_exc()
-         if args.log:
-            dtime = utcnow_seconds_str()
-            err   = f"{e.__class__.__name__}: {e}"
-            trace = traceback.format_exc()
-            logger.error(f"{dtime}\n{err}\n{trace}{'-'*114}")
-         browser.close(reason=str(e))
-         return
-      
-      # take a screenshot of the UWZ weather warning map
-      page.screenshot(
-         path = image_path,
-         clip = {
-            "x":        0,
-            "y":        0,
-            "width":    556,
-            "height":   600
-         }
-      )
-      # close the browser
-      browser.close()
+      if self.db is None:
+         self.db = sqlite3.connect(Path(self.args.output_dir, "retention.sqlite"), timeout=30, check_same_thread=False)
+         self.db.execute("CREATE TABLE IF NOT EXISTS frames (name TEXT, time INTEGER, file TEXT, step INTEGER, PRIMARY KEY (name, time))")
+         self.db.commit()
+      return self.db
+   
+   def add(self, name, dt_utc, file):
+      """
+      Adds a saved frame, which is kept at every step so far.
+      """
+      with self.lock:
+         db = self.connect()
+         db.execute("INSERT OR REPLACE INTO frames VALUES (?, ?, ?, 1)", (name, int(dt_utc.timestamp()), file))
+         db.commit()
    
-   # add watermark to the image
-   if args.watermark: add_watermark(image_path, "bl", dt_utc)
+   def scan(self):
+      """
+      Adds the existing frame files or archive entries of the output directory which are not indexed yet (once, e.g. when
+      the retention policy is introduced). Returns the number of added frames.
+      """
+      rows = []
+      for path in Path(self.args.output_dir).iterdir():
+         if self.args.storage == "archive":
+            if (match := re.fullmatch(r"(.+)_(\d{4}-\d{2}-\d{2})\.idx", path.name)) is None: continue
+            name, day = match.group(1), dt.strptime(match.group(2), "%Y-%m-%d").replace(tzinfo=tz.utc)
+            rows += [ (name, timestamp, f"{name}_{match.group(2)}.frames") for timestamp, _, _ in FrameArchive(self.args).entries(name, day) ]
+         elif (match := re.fullmatch(r"(.+)_(\d{4}-\d{2}-\d{2}_\d{4})\.\w+", path.name)) is not None:
+            rows.append((match.group(1), int(dt.strptime(match.group(2), "%Y-%m-%d_%H%M").replace(tzinfo=tz.utc).timestamp()), path.name))
+      with self.lock:
+         db    = self.connect()
+         added = db.total_changes
+         db.executemany("INSERT OR IGNORE INTO frames VALUES (?, ?, ?, 1)", rows)
+         db.commit()
+         return db.total_changes - added
    
+   def close(self):
+      """
+      Closes the database.
+      """
+      if self.db is not None: self.db.close()
+
 
-def d(args, dt_utc, logger):
+class RetentionCompactor:
    """
-   Takes a screenshot of the DWD weather warning map for Germany.
+   Applies the tiered retention policy to the output directory in a background thread, incrementally from the retention index:
+   once frames get older than a tier, only the first frame of every step of the next tier is kept (or all are deleted after the
+   last tier, unless it is *). Each frame is only looked at when it crosses a tier, so a run only touches a few frames.
+   Archive containers are compacted per finished day: the container and index of the day are rewritten without the deleted frames.
    """
-   # set the URL and image path
-   URL         = 'https://www.dwd.de/DE/wetter/warnungen_landkreise/warnWetter_node.html'
-   image_path  =  Path(f"{args.output_dir}/dwd_{dt_minutes_file(dt_utc)}.png")
+   # seconds between two runs of the compactor
+   check_interval = 600
    
-   # use playwright to take a screenshot of the DWD weather warning map
-   with sync_playwright() as p:
-      
-      # open the chosen browser
-      match args.browser:
-         case "chromium":
-            browser  = p.chromium.launch()
-         case "chrome":
-            browser  = p.chromium.launch(channel="chrome")
-         case "firefox":
-            browser = p.firefox.launch()
-         case "edge":
-            browser = p.chromium.launch(channel="msedge")
-         case "webkit":
-            browser = p.webkit.launch()
-         case _:
-            err = f"Browser {args.browser} not supported. Please choose from {browsers_available}."
-            if verbose: print(err)
-            logger.error(err)
-            return
+   def __init__(self, args, logger):
+      self.args      = args
+      self.logger    = logger
+      self.tiers     = retention_tiers(args.retention)
+      self.index     = RetentionIndex(args)
+      self.store     = FrameArchive(args) if args.storage == "archive" else FrameFiles(args)
+      self.stopped   = threading.Event()
+      self.thread    = threading.Thread(target=self.run, daemon=True)
+   
+   def start(self):
+      """
+      Starts the background thread.
+      """
+      self.thread.start()
+   
+   def boundaries(self):
+      """
+      Returns the tier boundaries: (age in seconds, step in minutes of the older frames or None = delete them).
+      """
+      return [
+         (age, self.tiers[i + 1][1] if i + 1 < len(self.tiers) else None)
+         for i, (age, _) in enumerate(self.tiers) if age != inf
+      ]
+   
+   def compact(self, now=None):
+      """
+      Applies the retention policy once. Returns the number of deleted frames.
+      """
+      now      = now or time()
+      deleted  = []
+      with self.index.lock:
+         db = self.index.connect()
+         for age, step in self.boundaries():
+            cutoff = now - age
+            # archives are only compacted by whole days which ended before the cutoff
+            if self.args.storage == "archive": cutoff -= cutoff % 86400
+            if step is None:
+               deleted += db.execute("SELECT name, time, file FROM frames WHERE time < ? ORDER BY name, time", (cutoff,)).fetchall()
+               db.execute("DELETE FROM frames WHERE time < ?", (cutoff,))
+               continue
+            # keep the first frame of every step (if the step has no kept frame yet) and delete the others
+            for name, timestamp, file in db.execute("SELECT name, time, file FROM frames WHERE time < ? AND step < ? ORDER BY name, time", (cutoff, step)).fetchall():
+               start = timestamp - timestamp % (step * 60)
+               if db.execute("SELECT 1 FROM frames WHERE name = ? AND time >= ? AND time < ? AND step >= ?", (name, start, start + step * 60, step)).fetchone():
+                  db.execute("DELETE FROM frames WHERE name = ? AND time = ?", (name, timestamp))
+                  deleted.append((name, timestamp, file))
+               else:
+                  db.execute("UPDATE frames SET step = ? WHERE name = ? AND time = ?", (step, name, timestamp))
+         db.commit()
+      # delete the frame files or rewrite the archive days without the deleted frames
+      if self.args.storage == "archive":
+         days = {}
+         for name, timestamp, file in deleted:
+            days.setdefault((name, dt.fromtimestamp(timestamp - timestamp % 86400, tz.utc)), set()).add(timestamp)
+         for (name, day), timestamps in days.items():
+            self.store.remove(name, day, timestamps)
+      else:
+         for name, timestamp, file in deleted:
+            Path(self.args.output_dir, file).unlink(missing_ok=True)
+      return len(deleted)
+   
+   def run(self):
+      """
+      Applies the retention policy every check_interval seconds until stopped.
+      """
+      while not self.stopped.is_set():
+         try:
+            if (deleted := self.compact()) and self.args.verbose: print(f"Retention: deleted {deleted} frame(s)")
+            if deleted: self.logger.info(f"Retention: deleted {deleted} frame(s)")
+         except Exception as e:
+            log_exception(e, self.args, self.logger)
+         self.stopped.wait(self.check_interval)
+   
+   def stop(self):
+      """
+      Stops the background thread and closes the index.
+      """
+      self.stopped.set()
+      if self.thread.is_alive(): self.thread.join()
+      self.index.close()
 
-      # create a new browser context with the given user agent and credentials
-      context  = browser.new_context(user_agent=args.user_agent)
-      page     = context.new_page()
-      # set the default timeout for the context and page
-      context.set_default_timeout(args.timeout)
-      page.set_default_timeout(args.timeout)
-        
-      # try to go to the URL
-      try:
-         page.goto(URL)
-      # if an error occurs, handle it
-      except Exception as e:
-         if args.verbose:
-            print(e)
-            traceback.print_exc()
-         if args.log:
-            dtime = utcnow_seconds_str()
-            err   = f"{e.__class__.__name__}: {e}"
-            trace = traceback.format_exc()
-            logger.error(f"{dtime}\n{err}\n{trace}{'-'*114}")
-         browser.close(reason=str(e))
-         return
-      
-      # wait for the map to be fully loaded
-      try:
-         page.wait_for_selector('#appBox') 
-         page.wait_for_selector('#headerBox')
-         page.wait_for_selector('#svgBox')
-         # if network_idle is True, wait for the network to be idle
-         if args.network_idle:
-            page.wait_for_load_state('networkidle')
-         # else just wait for the correct load state
-         else: page.wait_for_load_state('load')
-      # if an error occurs, handle it
-      except Exception as e:
-         if args.verbose:
-            print(e)
-            traceback.print_exc()
-         if args.log:
-            dtime = utcnow_seconds_str()
-            err   = f"{e.__class__.__name__}: {e}"
-            trace = traceback.format_exc()
-            logger.error(f"{dtime}\n{err}\n{trace}{'-'*114}")
-         browser.close(reason=str(e))
-         return
-      
-      # get the bounding boxes of the elements
-      app_box           = page.locator('#appBox').bounding_box()
-      header_box        = page.locator('#headerBox').bounding_box()
-      svg_box           = page.locator('#svgBox').bounding_box()
+
+def pyramid_levels(spec):
+   """
+   Parses the levels of the thumbnail pyramid, e.g. thumb:160,preview:640 -> { "thumb": 160, "preview": 640 } (maximum widths).
+   """
+   levels = {}
+   for level in spec.split(","):
+      if not level.strip(): continue
+      name, _, width = level.partition(":")
+      if not name.strip() or not width.strip().isdigit() or int(width) <= 0:
+         raise ValueError(f"Pyramid level {level.strip()} has to be NAME:WIDTH")
+      levels[name.strip()] = int(width)
+   return levels
+
+
+def pyramid_images(data, levels, args):
+   """
+   Returns the smaller sizes of a frame as (level, encoded image), in a process of the pyramid pool.
+   The frame is decoded only once (at a reduced size for JPEG) and every level is resampled from the next larger one.
+   """
+   from PIL import Image
+   
+   images   = []
+   image    = Image.open(BytesIO(data))
+   largest  = max(levels.values())
+   # JPEG frames are decoded right away at the smallest scale which is still larger than the largest level
+   if largest < image.width:
+      image.draft("RGB", (largest, ceil(image.height * largest / image.width)))
+   image.load()
+   for level, width in sorted(levels.items(), key=lambda level: level[1], reverse=True):
+      # the levels are never larger than the frame itself
+      if width < image.width:
+         image = image.resize((width, max(1, round(image.height * width / image.width))), Image.Resampling.LANCZOS, reducing_gap=3.0)
+      images.append((level, encode_image(image, args)))
+   return images
+
+
+def build_pyramid(data, name, dt_utc, levels, args):
+   """
+   Builds the smaller sizes of a frame (in a process of the pyramid pool) and saves them as {name}_{level} frames
+   next to the frame (or in their own archive). Returns the number of saved images.
+   """
+   store    = FrameArchive(args) if args.storage == "archive" else FrameFiles(args)
+   for level, image in pyramid_images(data, levels, args):
+      store.write(f"{name}_{level}", dt_utc, image)
+   return len(levels)
+
+
+def backfill_pyramid(args, names, start, end):
+   """
+   Builds the missing pyramid levels of the existing frames of the names between start and end with a pool of pyramid_workers processes.
+   The levels are saved by this process in time order (not as the pool finishes them). Returns the number of saved images.
+   """
+   levels   = pyramid_levels(args.pyramid)
+   store    = FrameArchive(args) if args.storage == "archive" else FrameFiles(args)
+   saved    = 0
+   with ProcessPoolExecutor(max_workers=args.pyramid_workers or None) as pool:
+      futures = []
+      for name in names:
+         for dt_utc, data in store.frames(name, start, end):
+            missing = { level: width for level, width in levels.items() if not store.exists(f"{name}_{level}", dt_utc) }
+            if missing and image_extension(data) != "svgz":
+               futures.append((name, dt_utc, pool.submit(pyramid_images, data, missing, args)))
+      for name, dt_utc, future in futures:
+         for level, image in future.result():
+            store.write(f"{name}_{level}", dt_utc, image)
+            saved += 1
+   return saved
+
+
+class FrameDeduplicator:
+   """
+   Compares each frame with the last saved frame of the same name, using an exact pixel hash (tolerance 0)
+   or a perceptual difference hash, whose bits may differ by up to dedup_tolerance.
+   Unchanged frames are not encoded again, they only extend the time range of the last frame in the manifest
+   ({name}_manifest.jsonl, one line per unique frame) and are linked to it in the frame store with dedup = link.
+   """
+   # the perceptual hash has hash_size * hash_size bits
+   hash_size = 16
+   
+   def __init__(self, args):
+      self.args   = args
+      # name -> last unique frame (manifest entry with its offset in the manifest)
+      self.frames = {}
+      self.locks  = {}
+      self.guard  = threading.Lock()
+   
+   def lock(self, name):
+      """
+      Returns the lock of a frame name, so frames of the same name are checked one after another.
+      """
+      with self.guard:
+         return self.locks.setdefault(name, threading.Lock())
+   
+   def hash(self, image):
+      """
+      Returns the exact or perceptual hash of the image as a hex string.
+      """
+      if not self.args.dedup_tolerance:
+         return hashlib.sha256(f"{image.size}{image.mode}".encode() + image.tobytes()).hexdigest()
       
-      # take a screenshot of the DWD weather warning map
-      page.screenshot(
-         path = image_path,
-         clip = {       
-            "x":        svg_box['x'],
-            "y":        svg_box['y'] - header_box['height'],
-            "width":    app_box['width'],
-            "height":   svg_box['height'] + header_box['height']
-         }
-      )
-      # close the browser
-      browser.close()
-   
-   # add watermark to the image
-   if args.watermark: add_watermark(image_path, "br", dt_utc)
-
-
-def m(args, dt_utc, logger):
-   """
-   Takes a screenshot of the MetMaps page using the given URL.
-   """
-   # set the image path
-   image_path = Path(f"{args.output_dir}/metmaps_{dt_minutes_file(dt_utc)}.png")
-   
-   # use playwright to take a screenshot of the MetMaps page
-   with sync_playwright() as p:  
-      # open the chosen browser
-      match args.browser:
-         case "chromium":
-            browser  = p.chromium.launch()
-         case "chrome":
-            browser  = p.chromium.launch(channel="chrome")
-         case "firefox":
-            browser = p.firefox.launch()
-         case "edge":
-            browser = p.chromium.launch(channel="msedge")
-         case "webkit":
-            browser = p.webkit.launch()
-         case _:
-            err = f"Browser {args.browser} not supported. Please choose from {browsers_available}."
-            if verbose: print(err)
-            logger.error(err)
-            return 
-      # create a new browser context with the given user agent and credentials
-      context  = browser.new_context(
-         user_agent = args.user_agent,
-         http_credentials  = {"username": args.username, "password": args.password}
-      )
-      # create a new page
-      page     = context.new_page()
-      # set the default timeout for the context and page
-      context.set_default_timeout(args.timeout)
-      page.set_default_timeout(args.timeout)
+      # difference hash: compare the brightness of neighboring pixels of a downscaled grayscale image
+      size     = self.hash_size
+      pixels   = image.convert("L").resize((size + 1, size)).tobytes()
+      bits     = 0
+      for row in range(size):
+         for col in range(size):
+            left  = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits  = bits << 1 | (left > right)
+      return f"{bits:0{size * size // 4}x}"
+   
+   def manifest_path(self, name):
+      """
+      Returns the path of the manifest of a frame name.
+      """
+      return Path(f"{self.args.output_dir}/{name}_manifest.jsonl")
+   
+   def last_frame(self, name):
+      """
+      Returns the last unique frame of a name, from memory or the last line of its manifest.
+      """
+      if name not in self.frames:
+         self.frames[name] = None
+         manifest = self.manifest_path(name)
+         if manifest.exists():
+            with open(manifest, "rb") as f:
+               # only read the end of the manifest, which contains the last line
+               size = f.seek(0, os.SEEK_END)
+               f.seek(max(0, size - 4096))
+               tail = f.read()
+            if tail.strip():
+               line              = tail.rstrip(b"\n").rsplit(b"\n", 1)[-1]
+               frame             = json.loads(line)
+               frame["offset"]   = size - len(tail) + tail.rstrip(b"\n").rfind(line)
+               self.frames[name] = frame
+      return self.frames[name]
+   
+   def same(self, hash_a, hash_b):
+      """
+      Returns True if the hashes are equal or differ by at most dedup_tolerance bits (perceptual hash).
+      """
+      if not self.args.dedup_tolerance or len(hash_a) != len(hash_b):
+         return hash_a == hash_b
+      return bin(int(hash_a, 16) ^ int(hash_b, 16)).count("1") <= self.args.dedup_tolerance
+   
+   def unchanged(self, name, frame_hash, dt_utc, store):
+      """
+      Returns True if the frame didn't change, after extending the time range of the last frame in the manifest.
+      """
+      frame = self.last_frame(name)
+      if frame is None or not self.same(frame["hash"], frame_hash):
+         return False
       
-      # try to go to the URL
-      try:
-         page.goto(args.URL)
-         # if network_idle is True, wait for the network to be idle
-         if args.network_idle:
-            page.wait_for_load_state('networkidle')
-         # else just wait for the correct load state
-         else: page.wait_for_load_state('load')
-      # if an error occurs, handle it
-      except Exception as e:
-         if args.verbose:
-            print(e)
-            traceback.print_exc()
-         if args.log:
-            dtime = utcnow_seconds_str()
-            err   = f"{e.__class__.__name__}: {e}"
-            trace = traceback.format_exc()
-            logger.error(f"{dtime}\n{err}\n{trace}{'-'*114}")
-         browser.close(reason=str(e))
-         return
+      # link the unchanged frame to the last saved one in the frame store, if desired
+      if self.args.dedup == "link": store.link(name, dt_utc, frame)
       
-      #TODO fixme or delete
+      # rewrite the last line of the manifest with the extended time range
+      frame["last"] = dt_minutes_mark(dt_utc)
+      with open(self.manifest_path(name), "r+b") as f:
+         f.seek(frame["offset"])
+         f.write(self.entry(frame))
+         f.truncate()
+      return True
+   
+   def record(self, name, frame_hash, dt_utc, location):
       """
-      inputimage = page.locator('form.mf').locator('table').nth(2).locator('tbody')\
-         .locator('tr').nth(3).locator('span#container').locator('div#imgdiv')\
-         .locator('span#outline').locator('input#inputimage')
-      inputimage.wait_for() 
+      Appends a new unique frame (with the file or container it is stored in) to the manifest.
       """
-      # try to get the bounding box of the image
-      try:
-         inputimage = page.locator('#inputimage').bounding_box()
-      # if an error occurs, handle it
-      except Exception as e:
-         if args.verbose:
-            print(e)
-            traceback.print_exc()
-         if log:
-            dtime = utcnow_seconds_str()
-            err   = f"{e.__class__.__name__}: {e}"
-            trace = traceback.format_exc()
-            logger.error(f"{dtime}\n{err}\n{trace}{'-'*114}")
-         browser.close(reason=str(e))
-         return
-      
-      # take a screenshot of the image
-      page.screenshot(
-         path = image_path,
-         clip = {       
-            "x":        inputimage['x'],
-            "y":        inputimage['y'],
-            "width":    inputimage['width'],
-            "height":   inputimage['height']
-         }
-      )
-      # close the browser
-      browser.close()
+      frame = { "file": location, "hash": frame_hash, "first": dt_minutes_mark(dt_utc), "last": dt_minutes_mark(dt_utc) }
+      with open(self.manifest_path(name), "ab") as f:
+         frame["offset"] = f.seek(0, os.SEEK_END)
+         f.write(self.entry(frame))
+      self.frames[name] = frame
    
-   # add watermark to the image
-   if args.watermark: add_watermark(image_path, "br", dt_utc)
-
+   @staticmethod
+   def entry(frame):
+      """
+      Returns the manifest line of a frame.
+      """
+      return (json.dumps({ k: v for k, v in frame.items() if k != "offset" }) + "\n").encode()
 
-# get names of all user defined functions https://stackoverflow.com/a/60894911/12935487
-all_sites = [f.__name__ for f in globals().values() if type(f) == type(lambda *args: None)]
-from playwright.sync_api import sync_playwright
-   
 
-def add_watermark(image_path, position, dt_utc):
-   """ 
-   Adds a datetime watermark to the image.
+class RollingAnimation:
+   """
+   Keeps a rolling animated WebP ({name}_loop.webp) of the last animation_window hours per frame name.
+   Every new frame is encoded once as a WebP still in {name}_loop/, the animation is then rebuilt by
+   concatenating the bitstreams of the stored stills as animation frames (ANMF chunks), so the loop is never re-encoded.
+   Frames less than animation_step minutes after the previous animation frame are left out (decimation).
    """
-   from PIL import Image, ImageFont, ImageDraw
+   # chunks of a WebP still which hold the image data
+   image_chunks = (b"ALPH", b"VP8 ", b"VP8L")
    
-   # open the image
-   image             = Image.open(image_path)
-   watermark_image   = image.copy()
-   draw              = ImageDraw.Draw(watermark_image)
+   def __init__(self, args):
+      self.args   = args
+      # name -> {datetime: (width, height, image chunks)} of the frames in the window
+      self.frames = {}
+      self.locks  = {}
+      self.guard  = threading.Lock()
    
-   # get the size of the image 
-   w, h = image.size
-   # set the position of the watermark  
-   if position == "bl":
-      # bottom left
-      x, y = int(w / 4), int(h - h / 50)
-      # set the font size, depending on the height of the image
-      font_size = int(h/18)
-   elif position == "br":
-      # bottom right 
-      x, y = int(w - w / 5), int(h - h / 50)
-      # set the font size, depending on the width of the image
-      font_size = int(w/20)
+   def lock(self, name):
+      """
+      Returns the lock of a frame name, so frames of the same name are added one after another.
+      """
+      with self.guard:
+         return self.locks.setdefault(name, threading.Lock())
    
-   #font = ImageFont.truetype("arial.ttf", int(font_size/12))
-   font = ImageFont.load_default(size=font_size)
-   # add watermark
-   draw.text((x, y), dt_minutes_mark(dt_utc), fill="red", font=font, anchor='ms')
-   # save the image with the watermark
-   watermark_image.save(image_path)
+   def stills_dir(self, name):
+      """
+      Returns the directory of the encoded stills of a frame name.
+      """
+      return Path(f"{self.args.output_dir}/{name}_loop")
+   
+   def window(self, name):
+      """
+      Returns the frames of a name in the window, loading the stored stills on first use (e.g. after a restart).
+      """
+      if name not in self.frames:
+         self.frames[name] = {}
+         for path in sorted(self.stills_dir(name).glob("*.webp")):
+            try:
+               dt_utc = dt.strptime(path.stem, "%Y%m%d%H%M").replace(tzinfo=tz.utc)
+               self.frames[name][dt_utc] = self.chunks(path.read_bytes())
+            except (ValueError, OSError): continue
+      return self.frames[name]
+   
+   def wants(self, name, dt_utc):
+      """
+      Returns True if the frame is not decimated, i.e. at least animation_step minutes after the last animation frame.
+      """
+      frames = self.window(name)
+      return not frames or dt_utc - max(frames) >= td(minutes=self.args.animation_step)
+   
+   @classmethod
+   def chunks(cls, data):
+      """
+      Returns width, height and the image chunks (with their headers and padding) of a WebP still.
+      """
+      from PIL import Image
+      
+      width, height  = Image.open(BytesIO(data)).size
+      chunks, pos    = [], 12
+      while pos + 8 <= len(data):
+         fourcc   = data[pos:pos + 4]
+         size     = int.from_bytes(data[pos + 4:pos + 8], "little")
+         end      = pos + 8 + size + (size & 1)
+         if fourcc in cls.image_chunks: chunks.append(data[pos:end])
+         pos      = end
+      return width, height, b"".join(chunks)
+   
+   def add(self, name, dt_utc, image):
+      """
+      Encodes the (watermarked) image as a still, drops the frames which left the window and rewrites the animation.
+      """
+      still    = BytesIO()
+      image.convert("RGB").save(still, format="WEBP", quality=self.args.animation_quality)
+      with self.lock(name):
+         frames = self.window(name)
+         if frames and dt_utc - max(frames) < td(minutes=self.args.animation_step): return
+         
+         stills_dir = self.stills_dir(name)
+         stills_dir.mkdir(exist_ok=True)
+         write_atomic(stills_dir / f"{dt_utc:%Y%m%d%H%M}.webp", still.getvalue())
+         frames[dt_utc] = self.chunks(still.getvalue())
+         
+         # forget the frames which are older than the window
+         for old in [ d for d in frames if d <= dt_utc - td(hours=self.args.animation_window) ]:
+            del frames[old]
+            (stills_dir / f"{old:%Y%m%d%H%M}.webp").unlink(missing_ok=True)
+         
+         write_atomic(Path(f"{self.args.output_dir}/{name}_loop.webp"), self.animation([ frames[d] for d in sorted(frames) ]))
+   
+   def animation(self, frames):
+      """
+      Returns an animated WebP (looping forever) of the frames, given as (width, height, image chunks).
+      """
+      le24        = lambda n: n.to_bytes(3, "little")
+      chunk       = lambda fourcc, payload: fourcc + len(payload).to_bytes(4, "little") + payload + b"\0" * (len(payload) & 1)
+      width       = max(frame[0] for frame in frames)
+      height      = max(frame[1] for frame in frames)
+      # the animation flag, canvas size, white background and infinite loop
+      body        = chunk(b"VP8X", b"\x02\0\0\0" + le24(width - 1) + le24(height - 1))
+      body       += chunk(b"ANIM", b"\xff\xff\xff\xff" + b"\0\0")
+      for frame_width, frame_height, image_chunks in frames:
+         # each frame at the top left corner, not blended with and disposed to the background afterwards
+         body    += chunk(b"ANMF", le24(0) + le24(0) + le24(frame_width - 1) + le24(frame_height - 1) + le24(self.args.animation_frame_ms) + b"\x03" + image_chunks)
+      return b"RIFF" + (len(body) + 4).to_bytes(4, "little") + b"WEBP" + body
 
 
 # datetime functions for easier handling
@@ -387,6 +2827,88 @@ def clear_output():
       print("\033c", end="")
 
 
+class TickScheduler:
+   """
+   Schedules the ticks on the interval grid beginning at start_datetime, using absolute deadlines on the monotonic clock.
+   Late ticks are handled by the missed-tick policy:
+   skip -> drop the missed ticks and wait for the next tick on the grid,
+   catchup -> take all missed ticks back-to-back,
+   coalesce -> take one tick now (labeled with the latest missed tick) instead of all missed ones.
+   """
+   def __init__(self, start_datetime, interval, policy, logger, verbose=False):
+      self.start_datetime  = start_datetime
+      self.interval        = interval
+      self.policy          = policy
+      self.logger          = logger
+      self.verbose         = verbose
+      # map the start datetime to the monotonic clock only once, so wall clock adjustments can't shift the grid
+      self.start_mono      = monotonic() + (start_datetime - dt.now(tz.utc)).total_seconds()
+      self.tick            = 0
+      # lateness statistics in seconds
+      self.ticks           = 0
+      self.missed          = 0
+      self.late_sum        = 0.0
+      self.late_max        = 0.0
+   
+   def deadline(self, tick):
+      """
+      Returns the monotonic deadline of the given tick number.
+      """
+      return self.start_mono + tick * self.interval
+   
+   def wait_start(self):
+      """
+      Sleeps until start_datetime, printing the remaining time once per second if verbose.
+      """
+      while (remaining := self.start_mono - monotonic()) > 0:
+         # if verbose is True, print the remaining time
+         if self.verbose:
+            # clear the all previous output and print the remaining time (without microseconds)
+            clear_output()
+            print(f"Waiting for the desired start_datetime minute to begin (remaining time: {td(seconds=int(remaining))})...")
+         # sleep until the next full second of the remaining time (or the start) instead of busy waiting
+         sleep(remaining % 1 or 1)
+   
+   def next_tick(self):
+      """
+      Waits for the deadline of the next tick and returns the datetime of the tick on the grid.
+      """
+      now      = monotonic()
+      # number of ticks which are completely over (their successor's deadline has passed as well)
+      missed   = max(0, int((now - self.deadline(self.tick)) // self.interval))
+      
+      if missed:
+         match self.policy:
+            case "skip":
+               # drop the missed ticks and the current late tick, wait for the next one on the grid
+               self.tick   += missed + 1
+               missed      += 1
+            case "coalesce":
+               # take only the latest missed tick, now
+               self.tick   += missed
+            case _:
+               # catch up: take every tick, so nothing is missed
+               missed      = 0
+      
+      # sleep until the absolute deadline of the tick
+      if (remaining := self.deadline(self.tick) - monotonic()) > 0:
+         sleep(remaining)
+      
+      # update and log the lateness statistics
+      lateness          = max(0.0, monotonic() - self.deadline(self.tick))
+      self.ticks        += 1
+      self.missed       += missed
+      self.late_sum     += lateness
+      self.late_max     = max(self.late_max, lateness)
+      dt_tick           = self.start_datetime + td(seconds=self.tick * self.interval)
+      stats             = f"tick {dt_minutes_mark(dt_tick)}: lateness {lateness:.3f}s, mean {self.late_sum / self.ticks:.3f}s, max {self.late_max:.3f}s, missed ticks {self.missed} ({self.policy})"
+      if self.verbose: print(stats)
+      self.logger.info(f"{stats}")
+      
+      self.tick += 1
+      return dt_tick
+
+
 if __name__ == '__main__':
 
    # read the config file
@@ -398,6 +2920,8 @@ if __name__ == '__main__':
    cf_debug          = config["debug"]
    cf_playwright     = config["playwright"]
    cf_metmaps        = config["metmaps"]
+   cf_output         = config["output"]
+   cf_cache          = config["cache"]
     
    # get general config elements
    cf_start_datetime = cf_general["start_datetime"]
@@ -406,20 +2930,75 @@ if __name__ == '__main__':
    cf_interval       = cf_general["interval"]
    cf_sites          = cf_general["sites"]
    cf_watermark      = cf_general["watermark"]
+   cf_engine         = cf_general["engine"]
+   cf_pool_size      = cf_general["pool_size"]
+   cf_targets        = cf_general["targets"]
+   cf_site_conc      = cf_general["site_concurrency"]
+   cf_missed_ticks   = cf_general["missed_ticks"]
+   cf_max_inflight   = cf_general["max_inflight"]
+   cf_overlap        = cf_general["overlap"]
+   cf_deadline       = cf_general["capture_deadline"]
+   cf_serve          = cf_general["serve"]
+   cf_serve_host     = cf_general["serve_host"]
+   cf_retries        = cf_general["retries"]
+   cf_backoff        = cf_general["backoff"]
+   cf_backoff_max    = cf_general["backoff_max"]
+   cf_breaker        = cf_general["breaker_threshold"]
+   cf_probe_timeout  = cf_general["probe_timeout"]
+   cf_change_driven  = cf_general["change_driven"]
+   cf_heartbeat      = cf_general["heartbeat"]
    # get debug config elements
    cf_log            = cf_debug["log"]
+   cf_log_file       = cf_debug["log_file"]
+   cf_log_max_mb     = cf_debug["log_max_mb"]
+   cf_log_rotate     = cf_debug["log_rotate"]
+   cf_log_backups    = cf_debug["log_backups"]
    cf_verbose        = cf_debug["verbose"]
    cf_join           = cf_debug["join"]
+   cf_metrics        = cf_debug["metrics"]
+   cf_metrics_file   = cf_debug["metrics_file"]
+   cf_prom_file      = cf_debug["prometheus_file"]
    # get playwright config elements
    cf_user_agent     = cf_playwright["user_agent"]
    cf_browser        = cf_playwright["browser"]
    cf_timeout        = cf_playwright["timeout"]
    cf_network_idle   = cf_playwright["network_idle"]
+   cf_max_uses       = cf_playwright["max_uses"]
+    
+   # get output config elements
+   cf_format         = cf_output["format"]
+   cf_compress_level = cf_output["compress_level"]
+   cf_lossless       = cf_output["lossless"]
+   cf_quality        = cf_output["quality"]
+   cf_encode_workers = cf_output["encode_workers"]
+   cf_dedup          = cf_output["dedup"]
+   cf_storage        = cf_output["storage"]
+   cf_dedup_tol      = cf_output["dedup_tolerance"]
+   cf_animation      = cf_output["animation"]
+   cf_anim_window    = cf_output["animation_window"]
+   cf_anim_step      = cf_output["animation_step"]
+   cf_anim_frame_ms  = cf_output["animation_frame_ms"]
+   cf_anim_quality   = cf_output["animation_quality"]
+   cf_vector         = cf_output["vector"]
+   cf_raster_widths  = cf_output["raster_widths"]
+   cf_raster_workers = cf_output["raster_workers"]
+   cf_pyramid        = cf_output["pyramid"]
+   cf_retention      = cf_output["retention"]
+   cf_pyramid_workers = cf_output["pyramid_workers"]
+    
+   # get cache config elements
+   cf_cache_enabled  = cf_cache["enabled"]
+   cf_cache_dir      = cf_cache["dir"]
+   cf_cache_ttl      = cf_cache["ttl"]
+   cf_cache_max_size = cf_cache["max_size"]
+   cf_cache_types    = cf_cache["types"]
+   cf_cache_live     = cf_cache["live_urls"]
     
    # get metmaps-specific config elements
    cf_username = cf_metmaps["username"]
    cf_password = cf_metmaps["password"]
    cf_URL      = cf_metmaps["URL"]
+   cf_batch_pages = cf_metmaps["batch_pages"]
    # if no URL is given, use the default URL 
    if cf_URL == "": cf_URL = "https://metmaps.eu/"
     
@@ -434,20 +3013,78 @@ if __name__ == '__main__':
    
    # add command line arguments
    parser.add_argument('start_end', nargs="*", default=[cf_start_datetime, cf_end_datetime], help="Start/end datetimes or date (format: YYYYMMDDhhmm OR hhmm). Can also be 'now' to start on the next full minute or 'max' (only second argument). If both arguments are 'now' (or no argument given with default config): take screenshot(s) immediatly.")
-   parser.add_argument('-s', '--sites', default=cf_sites, help="Choose sites to screenshot ([a]ll, [u]wz, [d]wd, [m]etmaps)")
+   parser.add_argument('-s', '--sites', default=cf_sites, help="Choose sites to screenshot by their letters in the [sites] registry of the config ([a]ll, by default [u]wz, [d]wd, [m]etmaps)")
    parser.add_argument('-i', '--interval', default=cf_interval, type=int, help="Recording interval in minutes")
    parser.add_argument('-o', '--output_dir', default=cf_output_dir, help="Output directory for the screenshots")
    parser.add_argument('-u', '--username', default=cf_username, help="Login username, if needed for site")
    parser.add_argument('-p', '--password', default=cf_password, help="Login password, if needed for site")
    parser.add_argument('-a', '--user_agent', default=cf_user_agent, help="Define a custom user agent, to pretend we are using a different browser")
-   parser.add_argument('-U', '--URL', default=cf_URL, help="custom URL for MetMaps")
+   parser.add_argument('-U', '--URL', default=cf_URL, help="custom URL for MetMaps, tim=YYYYmmddHHMM (and dd, mm, yy, hh, ii) are filled with the datetime of each tick")
+   parser.add_argument('-k', '--batch', type=int, help="Backfill the maps of the sites with a time URL (e.g. metmaps) between the start_end datetimes every BATCH minutes in parallel and exit")
+   parser.add_argument('--batch_pages', default=cf_batch_pages, type=int, help="Number of pages which load the metmaps maps of a batch in parallel")
    parser.add_argument('-w', '--watermark', action='store_true', default=cf_watermark, help="Add datetime watermark")
+   parser.add_argument('--max_inflight', default=cf_max_inflight, type=int, help="Maximum number of captures in flight over all sites (0 = unlimited)")
+   parser.add_argument('--overlap', default=cf_overlap, choices={"skip", "queue"}, help="Skip or queue the tick of a site whose previous capture is still in flight")
+   parser.add_argument('-D', '--capture_deadline', default=cf_deadline, type=int, help="Hard deadline of a capture in seconds, after which it is killed with its browser (0 = none)")
+   parser.add_argument('-r', '--retries', default=cf_retries, type=int, help="Retries of a failed capture, as long as they can finish before the next tick")
+   parser.add_argument('--backoff', default=cf_backoff, type=float, help="Base of the jittered exponential backoff between retries in seconds")
+   parser.add_argument('--backoff_max', default=cf_backoff_max, type=float, help="Maximum backoff between retries in seconds")
+   parser.add_argument('-B', '--breaker_threshold', default=cf_breaker, type=int, help="Failed captures in a row after which only probes are sent to a site until it recovers (0 = no circuit breaker)")
+   parser.add_argument('--probe_timeout', default=cf_probe_timeout, type=int, help="Timeout of a probe (and minimum time a retry needs before the next tick) in seconds")
+   parser.add_argument('-C', '--change_driven', default=cf_change_driven, type=int, help="Only take a screenshot if the content fingerprint of the site changed since the last frame (1 = on, 0 = off)")
+   parser.add_argument('--heartbeat', default=cf_heartbeat, type=int, help="Force a frame of an unchanged target every HEARTBEAT minutes in change-driven mode (0 = only on changes)")
+   parser.add_argument('-M', '--missed_ticks', default=cf_missed_ticks, choices={"skip", "catchup", "coalesce"}, help="What to do with ticks which are late by more than an interval: skip them, catch them all up or coalesce them into one")
+   parser.add_argument('-P', '--serve', default=cf_serve, type=int, help="Daemon mode: serve the latest frames, on-demand captures and the status over a local HTTP API on this port (0 = off)")
+   parser.add_argument('--serve_host', default=cf_serve_host, help="Address the HTTP API listens on")
    parser.add_argument('-l', '--log', action='store_true', default=cf_log, help="Enable logging")
+   parser.add_argument('--log_file', default=cf_log_file, help="Log file with one JSON record per line")
+   parser.add_argument('--log_max_mb', default=cf_log_max_mb, type=int, help="Rotate the log file at this size in MB (0 = never)")
+   parser.add_argument('--log_rotate', default=cf_log_rotate, choices=("", "h", "d", "midnight"), help="Rotate the log file by time instead of size (h, d or midnight)")
+   parser.add_argument('--log_backups', default=cf_log_backups, type=int, help="Number of rotated log files to keep")
    parser.add_argument('-v', '--verbose', action='store_true', default=cf_verbose, help="Print verbose output")
+   parser.add_argument('-m', '--metrics', default=cf_metrics, type=int, help="Write the phase durations of every capture to the metrics files (1 = on, 0 = off)")
+   parser.add_argument('--metrics_file', default=cf_metrics_file, help="JSON lines file with the timing record of every capture")
+   parser.add_argument('--prometheus_file', default=cf_prom_file, help="Prometheus text-format file with histograms of the phase durations (empty = none)")
+   parser.add_argument('--stats', action='store_true', help="Print p50/p95/p99 of the phase durations per site from the metrics file and exit")
    parser.add_argument('-j', '--join', action='store_true', help="Join the processes")
    parser.add_argument('-b', '--browser', default=cf_browser, choices=browsers_available, help="Choose the headless browser (e.g. chromium, firefox or other supported/installed browser)")
    parser.add_argument('-t', '--timeout', default=cf_timeout, type=int, help="Timeout for the browser in seconds")
    parser.add_argument('-n', '--network_idle', action='store_true', default=cf_network_idle, help="Wait for network idle state before taking screenshot (default: False)")
+   parser.add_argument('-e', '--engine', default=cf_engine, choices={"process", "async", "pool"}, help="Capture engine: one process per site type, all targets concurrently in one asyncio process or a pool of processes with load-aware balancing")
+   parser.add_argument('--pool_size', default=cf_pool_size, type=int, help="Number of capture processes of the pool engine (0 = number of CPU cores)")
+   parser.add_argument('-T', '--targets', dest="target_names", default=cf_targets, help="Comma-separated names of [target.NAME] config sections to capture in addition to the sites ('all' = all configured targets)")
+   parser.add_argument('--site_concurrency', default=cf_site_conc, type=int, help="Maximum number of concurrent captures per site")
+   parser.add_argument('-f', '--format', default=cf_format, choices=set(extensions), help="Output format of the screenshots")
+   parser.add_argument('--compress_level', default=cf_compress_level, type=int, help="PNG compression level 0-9 (-1 = keep the browser's PNG if no watermark is added)")
+   parser.add_argument('--lossless', default=cf_lossless, type=int, help="Lossless WebP (1) or lossy WebP (0)")
+   parser.add_argument('-q', '--quality', default=cf_quality, type=int, help="Quality of lossy WebP/JPEG (1-100) or compression effort of lossless WebP (0-100)")
+   parser.add_argument('--encode_workers', default=cf_encode_workers, type=int, help="Number of threads per capture process which encode and save the screenshots")
+   parser.add_argument('-S', '--storage', default=cf_storage, choices={"files", "archive"}, help="Save every frame as a loose file or append it to per-day archive containers")
+   parser.add_argument('-x', '--export', help="Export archived frames of these comma-separated frame names (e.g. dwd,uwz) between the start_end datetimes as loose files")
+   parser.add_argument('--export_dir', default="export", help="Directory for exported frames")
+   parser.add_argument('--dedup', default=cf_dedup, choices={"off", "manifest", "link"}, help="Don't save unchanged frames again: only extend their time range in the manifest (and hard link them)")
+   parser.add_argument('--dedup_tolerance', default=cf_dedup_tol, type=int, help="0 = frames must be pixel-identical, else the number of perceptual hash bits (of 256) which may differ")
+   parser.add_argument('-A', '--animation', default=cf_animation, type=int, help="Keep a rolling animated WebP ({name}_loop.webp) per frame name, updated with every new frame (1 = on, 0 = off)")
+   parser.add_argument('--animation_window', default=cf_anim_window, type=int, help="Hours of frames in the rolling animation")
+   parser.add_argument('--animation_step', default=cf_anim_step, type=int, help="Minimum minutes between two frames of the animation (decimation)")
+   parser.add_argument('--animation_frame_ms', default=cf_anim_frame_ms, type=int, help="Display duration of each animation frame in milliseconds")
+   parser.add_argument('--animation_quality', default=cf_anim_quality, type=int, help="WebP quality of the animation frames (1-100)")
+   parser.add_argument('-V', '--vector', default=cf_vector, type=int, help="Also save the vector map of sites with a vector element (e.g. the DWD SVG) as {name}_vector .svgz frame (1 = on, 0 = off)")
+   parser.add_argument('-R', '--rasterize', help="Rasterize the vector frames of these comma-separated frame names (e.g. dwd_vector) between the start_end datetimes in all raster widths into the export directory, without a browser (needs cairosvg)")
+   parser.add_argument('--raster_widths', default=cf_raster_widths, help="Comma-separated widths in pixels of the rasterized vector frames")
+   parser.add_argument('--retention', default=cf_retention, help="Tiered retention policy as comma-separated AGE:STEP tiers, e.g. 24h:1,30d:15,*:60 (every frame for 24 hours, every 15 minutes for 30 days, then hourly; empty = keep everything)")
+   parser.add_argument('--compact', action='store_true', help="Add the existing frames of the output directory to the retention index, apply the retention policy once and exit")
+   parser.add_argument('--pyramid', default=cf_pyramid, help="Comma-separated NAME:WIDTH levels of the thumbnail pyramid built for every new frame, saved as {name}_{NAME} frames (empty = none)")
+   parser.add_argument('--pyramid_workers', default=cf_pyramid_workers, type=int, help="Number of processes which build the thumbnail pyramids (0 = number of CPU cores)")
+   parser.add_argument('--pyramid_backfill', help="Build the missing pyramid levels of the existing frames of these comma-separated frame names (e.g. dwd,uwz) between the start_end datetimes and exit")
+   parser.add_argument('--raster_workers', default=cf_raster_workers, type=int, help="Number of processes which rasterize the vector frames (0 = number of CPU cores)")
+   parser.add_argument('-c', '--cache', default=cf_cache_enabled, type=int, help="Keep static assets and map tiles in an on-disk HTTP cache across runs (1 = on, 0 = off)")
+   parser.add_argument('--cache_dir', default=cf_cache_dir, help="Directory of the HTTP cache")
+   parser.add_argument('--cache_ttl', default=cf_cache_ttl, type=int, help="Seconds a cached response stays valid")
+   parser.add_argument('--cache_max_size', default=cf_cache_max_size, type=int, help="Maximum size of the HTTP cache in MB (least recently used entries are evicted)")
+   parser.add_argument('--cache_types', default=cf_cache_types, help="Comma-separated resource types which may be cached")
+   parser.add_argument('--cache_live_urls', default=cf_cache_live, help="Comma-separated URL patterns which are always fetched live")
+   parser.add_argument('--max_uses', default=cf_max_uses, type=int, help="Relaunch the browser after this many screenshots (0 = only after a crash)")
    
    # parse command line arguments
    args     = parser.parse_args()
@@ -461,111 +3098,158 @@ if __name__ == '__main__':
       for arg in vars(args):
          print(f"{arg}: {getattr(args, arg)}")
    
+   # print the statistics of the metrics file and exit
+   if args.stats:
+      print_stats(args.metrics_file)
+      sys.exit()
+   
+   # export archived frames as loose files and exit, the start_end datetimes are the time range
+   if args.export:
+      if len(args.start_end) != 2 or not all(len(d) == 12 for d in args.start_end):
+         sys.exit("WRONG INPUT: --export needs start and end datetime as YYYYmmddHHMM!")
+      start, end  = ( dt.strptime(d, "%Y%m%d%H%M").replace(tzinfo=tz.utc) for d in args.start_end )
+      exported    = export_frames(args, args.export.split(","), start, end)
+      if verbose: print(f"Exported {exported} frame(s) to {args.export_dir}")
+      sys.exit()
+   
+   # check the levels of the thumbnail pyramid and the tiers of the retention policy
+   try:
+      pyramid_levels(args.pyramid)
+      retention_tiers(args.retention)
+   except ValueError as e:
+      sys.exit(f"WRONG INPUT: {e}")
+   
+   # index the existing frames, apply the retention policy once and exit
+   if args.compact:
+      if not args.retention: sys.exit("WRONG INPUT: --compact needs a retention policy (--retention)!")
+      Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+      compactor   = RetentionCompactor(args, logging.getLogger(__name__))
+      indexed     = compactor.index.scan()
+      deleted     = compactor.compact()
+      compactor.index.close()
+      if verbose: print(f"Indexed {indexed} new frame(s), deleted {deleted} frame(s)")
+      sys.exit()
+   
+   # build the missing pyramid levels of existing frames and exit, the start_end datetimes are the time range
+   if args.pyramid_backfill:
+      if len(args.start_end) != 2 or not all(len(d) == 12 for d in args.start_end):
+         sys.exit("WRONG INPUT: --pyramid_backfill needs start and end datetime as YYYYmmddHHMM!")
+      if not pyramid_levels(args.pyramid):
+         sys.exit("WRONG INPUT: --pyramid_backfill needs the levels of the pyramid (--pyramid)!")
+      start, end  = ( dt.strptime(d, "%Y%m%d%H%M").replace(tzinfo=tz.utc) for d in args.start_end )
+      built       = backfill_pyramid(args, args.pyramid_backfill.split(","), start, end)
+      if verbose: print(f"Built {built} pyramid image(s)")
+      sys.exit()
+   
+   # rasterize vector frames in all raster widths and exit, the start_end datetimes are the time range
+   if args.rasterize:
+      from importlib.util import find_spec
+      if len(args.start_end) != 2 or not all(len(d) == 12 for d in args.start_end):
+         sys.exit("WRONG INPUT: --rasterize needs start and end datetime as YYYYmmddHHMM!")
+      if find_spec("cairosvg") is None:
+         sys.exit("--rasterize needs cairosvg, install it with: pip install cairosvg")
+      start, end  = ( dt.strptime(d, "%Y%m%d%H%M").replace(tzinfo=tz.utc) for d in args.start_end )
+      widths      = [ int(width) for width in args.raster_widths.split(",") ]
+      rasterized  = rasterize_frames(args, args.rasterize.split(","), widths, start, end)
+      if verbose: print(f"Rasterized {rasterized} image(s) to {args.export_dir}")
+      sys.exit()
+   
    args.timeout *= 1000  # convert seconds to milliseconds for playwright
 
-   # if the URL contains a datetime, replace it with the current datetime
-   # replace a tim=YYYYmmddHHMM with the current datetime using regex
-   if "tim=" in cf_URL:
-      # import regex module
-      import re
-      # substitute the datetime in the URL with the current datetime
-      cf_URL = re.sub(r'tim=\d{12}', f'tim={utcnow_metmaps_str()}', cf_URL)
-      # if verbose: print(cf_URL)
-      if verbose:
-         print(f"Replaced 'tim=YYYYmmddHHMM' with 'tim={utcnow_metmaps_str()}' in the URL")
+   # load, validate and compile the site registry of the config, the URL option replaces the URL of metmaps
+   try:
+      args.site_registry = load_sites(config, { "m": args.URL })
+   except (ValueError, configparser.Error) as e:
+      sys.exit(f"WRONG INPUT: {e}")
+   
+   # get the request filters (and live URL patterns) of the sites from their config sections
+   args.request_filters = {
+      site: RequestFilter(**{ key: config.get(entry["name"], key, fallback="") for key in ("block_types", "block_urls", "allow_urls", "live_urls") })
+      for site, entry in args.site_registry.items()
+   }
    
-   # if logging is turned off: log error messages
+   # get the readiness strategies of the sites from their config sections
+   args.readiness = { site: entry["readiness"] for site, entry in args.site_registry.items() }
+   
+   # if logging is turned on: log error messages, captures and tick statistics as JSON lines in the log writer process
    if args.log:
-      log         = True
-      log_level   = logging.ERROR
-   # else only log critical (effectively nothing)
-   else:
-      log_level   = logging.CRITICAL
-      log         = False
+      log_writer_process = LogWriter(args)
+      log_writer_process.start()
+      log_queue = log_writer_process.queue
    
    # create logger
    logger = logging.getLogger(__name__)
-   # configure the error log
-   logging.basicConfig(filename='error.log', level=log_level)
+   # send the log records of the main process to the log writer process, too
+   configure_logging(log_queue, args)
    
    # if all sites are desired, take all sites, else only the ones specified
    if args.sites == 'a':
-      sites = all_sites[:]
+      sites = list(args.site_registry)
    else:
-      # check if all sites are in the list of all sites
-      sites = [ i for i in all_sites if i in args.sites ]
+      # check if all sites are in the site registry
+      sites = [ i for i in args.site_registry if i in args.sites ]
+   # the batch backfills the maps of all sites with a time URL (e.g. metmaps), whichever sites the ticks capture
+   if args.batch: sites += [ site for site, entry in args.site_registry.items() if entry["time_url"] and site not in sites ]
+   
+   # the targets to capture: the default targets of the desired sites and the configured targets named by --targets
+   args.targets   = { site: site_target(site, args) for site in sites }
+   configured     = config_targets(config, args)
+   names          = list(configured) if args.target_names == "all" else [ n.strip() for n in args.target_names.split(",") if n.strip() ]
+   if unknown := [ name for name in names if name not in configured ]:
+      sys.exit(f"WRONG INPUT: unknown target(s) {', '.join(unknown)}, configured are: {', '.join(configured) or 'none'}")
+   args.targets  |= { name: configured[name] for name in names }
+   # the extra regions of the targets, captured from the same page load
+   try:
+      config_regions(config, args.targets, set(args.site_registry) | set(configured))
+   except (ValueError, configparser.Error) as e:
+      sys.exit(f"WRONG INPUT: {e}")
    
    # create output directory if not existing yet
    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+   
+   # backfill the maps of the sites with a time URL (e.g. metmaps) of the time range (start_end datetimes) every batch minutes in parallel and exit
+   if args.batch:
+      if len(args.start_end) != 2 or not all(len(d) == 12 for d in args.start_end):
+         sys.exit("WRONG INPUT: --batch needs start and end datetime as YYYYmmddHHMM!")
+      if not any(args.site_registry[target["site"]]["time_url"] for target in args.targets.values()):
+         sys.exit("WRONG INPUT: --batch needs a site with time_url = 1 in the site registry!")
+      start, end  = ( dt.strptime(d, "%Y%m%d%H%M").replace(tzinfo=tz.utc) for d in args.start_end )
+      times       = [ start + td(minutes=i * args.batch) for i in range(int((end - start) / td(minutes=args.batch)) + 1) ]
+      captured, maps = asyncio.run(capture_batch(args, times, logger))
+      if verbose: print(f"Captured {captured} frame(s) of {maps} map(s)")
+      sys.exit()
 
    
-   def get_screenshots(join=True):
+   # create long-lived capture processes, which keep their browser warm across ticks (depending on the engine)
+   workers = create_workers(args, logger)
+   
+   # send the capture jobs to the capture processes, keeping track of the captures in flight
+   dispatcher = CaptureDispatcher(workers, args, logger)
+   
+   # apply the retention policy to the output directory in the background (if desired)
+   compactor  = RetentionCompactor(args, logger) if args.retention else None
+   if compactor is not None: compactor.start()
+   
+   # serve the latest frames, on-demand captures and the status over a local HTTP API (daemon mode)
+   control    = ControlServer(dispatcher, args, logger) if args.serve else None
+   if control is not None and verbose: print(f"HTTP API on http://{args.serve_host}:{args.serve}")
+   
+   def get_screenshots(dt_utc, join=True):
       """
-      Takes screenshots of the desired sites.
+      Takes screenshots of the desired sites for the given datetime.
       """
       errors = {}
-
-      # take screenshots for each desired website
-      for site in sites:
-         # get the function for the desired site
-         site_function = globals()[site]
-         # get the current datetime in UTC timezone
-         dt_utc = dt.now(tz.utc)
-         # create a new process for each site with the given arguments
-         p = Process(
-               target=site_function,
-               args=(args, dt_utc, logger)
-            )
+      
+      # send a job for each target to a capture process
+      for key in args.targets:
          try:
-            # start the process in the background
-            p.start()
-            # if join is True, wait for the process to finish
-            if join: p.join()
+            dispatcher.submit(key, dt_utc)
          except Exception as e:
-            errors[site] = e
-            if verbose:
-               print(e)
-               traceback.print_exc()
-            if log:
-               dtime = utcnow_seconds_str()
-               err   = f"{e.__class__.__name__}: {e}"
-               trace = traceback.format_exc()
-               logger.error(f"{dtime}\n{err}\n{trace}{'-'*114}")
-            # if we have an error, we want to close the process and continue with the next site (if any)
-            try:
-               # if the process is still running, close it
-               p.close()
-            except Exception as e:
-               errors[site] = e
-               if verbose:
-                  print(e)
-                  traceback.print_exc()
-               if log:
-                  dtime = utcnow_seconds_str()
-                  err   = f"{e.__class__.__name__}: {e}"
-                  trace = traceback.format_exc()
-                  logger.error(f"{dtime}\n{err}\n{trace}{'-'*114}")
-               # if we can't terminate the process, we want to terminate it
-               try:
-                  p.terminate()
-               except Exception as e:
-                  errors[site] = e
-                  if verbose:
-                     print(e)
-                     traceback.print_exc()
-                  if log:
-                     dtime = utcnow_seconds_str()
-                     err   = f"{e.__class__.__name__}: {e}"
-                     trace = traceback.format_exc()
-                     logger.error(f"{dtime}\n{err}\n{trace}{'-'*114}")
-                  # as a last resort, we want to kill the process
-                  # not using try/finally here, because it should never fail
-                  p.kill()
-               # to make sure we continue with the next site, we use finally
-               # see https://stackoverflow.com/questions/11551996/why-do-we-need-the-finally-clause-in-python
-               finally: continue
-            finally: continue
-         finally: continue
+            errors[key] = e
+            log_exception(e, args, logger)
+      
+      # if join is True, wait for all captures to finish
+      if join: dispatcher.wait()
      
       # if we had errors, return them else the empty dict
       return errors
@@ -646,10 +3330,13 @@ if __name__ == '__main__':
    # if end_datetime is 'now', take a screenshot immediately and exit the script
    elif end_datetime == "now":
       if verbose: print("Taking screenshot(s) NOW...")
-      errors = get_screenshots(join=args.join)
+      errors = get_screenshots(dt.now(tz.utc), join=args.join)
       if errors:
          for e in errors:
              print(f"Error while taking screenshot(s) for {e}: {errors[e]}")
+      # wait for the captures to finish before exiting
+      dispatcher.stop()
+      if compactor is not None: compactor.stop()
       sys.exit()
    # if the input is not valid, exit the script
    else: sys.exit("WRONG INPUT: end_datetime has to be 4 or 12 characters long!")
@@ -659,33 +3346,28 @@ if __name__ == '__main__':
       sys.exit("WRONG INPUT: end_datetime needs to be in the future!")
    
 
+   # schedule the ticks on the interval grid, beginning at start_datetime
+   scheduler = TickScheduler(start_datetime, args.interval * 60, args.missed_ticks, logger, verbose)
+   if control is not None: control.scheduler = scheduler
+   
    # wait for start time to begin
-   while dt.now(tz.utc) < start_datetime:
-      # if verbose is True, print the remaining time
-      if verbose:
-         # get the remaining time until the start_datetime
-         remaining_time = start_datetime - dt.now(tz.utc)
-         # remove the microseconds from timedelta remaining_time
-         remaining_time -= td(microseconds=remaining_time.microseconds)
-         # clear the all previous output and print the remaining time
-         clear_output()
-         print(f"Waiting for the desired start_datetime minute to begin (remaining time: {remaining_time})...")
-      # sleep for a very short time to not overload the CPU
-      sleep(0.0000001)
+   scheduler.wait_start()
    
    # if verbose is True, print that we are starting to take screenshots now
    if verbose: print("Starting to take screenshot(s) NOW...")
    
-   # start taking screenshots
-   while dt.now(tz.utc) <= end_datetime:
+   # start taking screenshots, the last tick is at the original end_datetime (the interval was added)
+   while (dt_tick := scheduler.next_tick()) < end_datetime:
       
       # if verbose is True, print the current datetime
       if verbose:
          # clear the all previous output and print the current datetime
          #clear_output()
          print(f"Taking screenshot(s) at {utcnow_seconds_str()}...")
-      # take screenshots of all desired sites
-      get_screenshots(join=args.join)
-      
-      # sleep for the given interval
-      sleep(args.interval * 60)
+      # take screenshots of all desired sites for the datetime of the tick
+      get_screenshots(dt_tick, join=args.join)
+   
+   # wait for the captures to finish their last jobs
+   dispatcher.stop()
+   if compactor is not None: compactor.stop()
+   if control is not None: control.shutdown()